@@ -8,7 +8,9 @@
 
 """Contains the settings to repository modifications."""
 
-from github import Github
+import os
+
+from automation_tools.github_api import GithubSession, github_client
 
 # The organization name
 organization = "inveniosoftware"
@@ -19,5 +21,89 @@ destination = "origin"
 # Directory path to hold a copy of the repositories
 local_repositories_path = '/path/to/inveniosoftware_cache'
 
-# Github credentials / token
-github = Github()
+# Git reference the local repositories are read at, straight from their
+# object store (e.g. 'HEAD', works on bare mirrors). None reads the files
+# of the working trees, or the HEAD of the mirrors.
+repository_ref = None
+
+# Whether syncing the local repositories removes the ones archived or deleted
+# upstream (they may hold local work)
+prune_local_repositories = False
+
+# Layout of the local repositories:
+# - 'clone': a full clone, with its working tree, per repository
+# - 'mirror': a bare mirror per repository; working trees are checked out
+#   on demand as disposable worktrees, recycled once done
+storage_mode = 'clone'
+
+# Directory path to hold the disposable worktrees of the mirrors
+local_worktrees_path = '/path/to/inveniosoftware_worktrees'
+
+# Mirrors sharing the objects of another mirror through git alternates
+# (e.g. forks), as {repository: referenced repository}. Garbage collection
+# is disabled in the referenced mirrors, so that objects are never removed
+# from under the mirrors borrowing them.
+mirror_references = {}
+
+# Number of file contents kept in memory when reading from the object store
+blob_cache_size = 1024
+
+# Number of repositories cloned at the same time
+clone_workers = 8
+
+# Seconds after which a clone is aborted (None to wait forever)
+clone_timeout = 600
+
+# Number of times a failed clone is retried
+clone_retries = 2
+
+# URL the branches are pushed to, formatted with the organization and the
+# repository names (e.g. 'git@github.com:{organization}/{repository}.git'
+# to push over SSH). None pushes to the destination remote.
+push_url = None
+
+# Number of repositories pushed at the same time
+push_workers = 8
+
+# Directory holding the sockets of the multiplexed SSH connections of the pushes
+ssh_control_directory = '~/.ssh/automation-tools'
+
+# Seconds a multiplexed SSH connection stays open after its last push
+ssh_control_persist = 60
+
+# Backend running git operations on local repositories:
+# - 'subprocess': spawn git commands
+# - 'pygit2': status, staging and commits in-process (cannot open partial clones)
+git_backend = 'subprocess'
+
+# Github token (None for anonymous requests)
+github_token = os.environ.get('GH_ACCESS_TOKEN')
+
+# Connections kept open to the GitHub API
+github_pool_size = 16
+
+# Number of times a GitHub API request is retried on errors and rate limits
+github_retries = 5
+
+# Seconds between two writes to the GitHub API (e.g. opening PRs), to stay
+# below the secondary rate limits
+github_seconds_between_writes = 1.0
+
+# Below this number of remaining requests, the next ones are spread until
+# the rate limit budget is reset
+github_budget_reserve = 500
+
+# Number of GitHub API requests sent at the same time when fanned out across
+# repositories (e.g. opening PRs)
+github_concurrency = 8
+
+# Directory path to hold the GitHub API responses, revalidated with their
+# ETag (None to disable)
+github_cache_path = '.github-cache'
+
+# Github clients: PyGithub and a caching HTTP session
+github = github_client(github_token, github_pool_size, github_retries,
+                       github_seconds_between_writes)
+github_session = GithubSession(github_token, github_cache_path, github_pool_size,
+                               github_retries, github_seconds_between_writes,
+                               github_budget_reserve)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2020 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Rate-limit-aware clients of the GitHub API."""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from os import path
+
+import requests
+from github import Github, GithubRetry
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+API_URL = 'https://api.github.com'
+
+# Methods creating content, limited to one request every few seconds by GitHub
+WRITE_METHODS = {'POST', 'PATCH', 'PUT', 'DELETE'}
+
+
+def github_client(token=None, pool_size=16, retries=5, seconds_between_writes=1.0):
+    """PyGithub client with pooled connections and rate limit aware retries.
+
+    Rate limited requests wait for the ``Retry-After`` delay or the budget
+    reset before being retried, and writes are spaced out, so that long
+    runs do not trigger the secondary rate limits.
+    """
+    return Github(token, per_page=100, pool_size=pool_size, retry=GithubRetry(total=retries),
+                  seconds_between_writes=seconds_between_writes)
+
+
+class GithubSession(requests.Session):
+    """HTTP session to the GitHub REST and GraphQL APIs.
+
+    Connections are pooled and failed requests retried with backoff. Every
+    request is paced against the budget reported by the ``X-RateLimit-*``
+    headers of the previous ones: once fewer than ``budget_reserve``
+    requests remain, the next ones are spread until the budget is reset.
+    Rate limited requests wait and are retried.
+
+    GET responses are cached on disk along with their ETag and revalidated
+    with ``If-None-Match``; a 304 does not count against the budget and the
+    cached response is returned instead.
+
+    A session can be shared between threads.
+    """
+    def __init__(self, token=None, cache_path=None, pool_size=16, retries=5, seconds_between_writes=1.0,
+                 budget_reserve=500):
+        super(GithubSession, self).__init__()
+        self.headers['Accept'] = 'application/vnd.github.v3+json'
+        if token:
+            self.headers['Authorization'] = f'token {token}'
+        self.cache_path = cache_path
+        self.retries = retries
+        self.seconds_between_writes = seconds_between_writes
+        self.budget_reserve = budget_reserve
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=1,
+                                                status_forcelist=[500, 502, 503, 504]))
+        self.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.budgets = {}  # Resource -> (remaining requests, reset timestamp)
+        self.next_write = 0
+
+    def request(self, method, url, *args, **kwargs):
+        """Send a paced request, answered from the cache if not modified."""
+        key = self.cache_key(method, url, kwargs.get('params'))
+        cached = self.load(key)
+        if cached:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'If-None-Match': cached['etag']})
+
+        for attempt in range(self.retries + 1):
+            self.pace(method, url)
+            response = super(GithubSession, self).request(method, url, *args, **kwargs)
+            self.update_budget(response)
+            delay = self.rate_limit_delay(response)
+            if delay is None or attempt == self.retries:
+                break
+            time.sleep(delay)
+
+        if cached and response.status_code == 304:
+            return self.cached_response(response, cached)
+        if key and response.status_code == 200 and 'ETag' in response.headers:
+            self.store(key, response)
+        return response
+
+    def get_pages(self, url, params=None):
+        """Iterate over the items of a paginated REST listing."""
+        params = dict(params or {}, per_page=100)
+        while url:
+            response = self.get(url, params=params)
+            response.raise_for_status()
+            yield from response.json()
+            url = response.links.get('next', {}).get('url')
+            params = None  # Already part of the next page link
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query and return its data, raising on errors."""
+        response = self.post(f'{API_URL}/graphql', json={'query': query, 'variables': variables or {}})
+        response.raise_for_status()
+        result = response.json()
+        if result.get('errors'):
+            raise Exception(f"GraphQL query failed: {result['errors'][0]['message']}")
+        return result['data']
+
+    @staticmethod
+    def resource(url):
+        """Name of the rate limit budget a request is counted against."""
+        if url.endswith('/graphql'):
+            return 'graphql'
+        if '/search/' in url:
+            return 'search'
+        return 'core'
+
+    def pace(self, method, url):
+        """Wait as long as the remaining budget and the pace of writes require."""
+        now = time.time()
+        with self.lock:
+            delay = 0
+            remaining, reset = self.budgets.get(self.resource(url), (None, None))
+            if remaining is not None and remaining < self.budget_reserve:
+                delay = max(reset - now, 0) / max(remaining, 1)
+            # GraphQL queries are sent with POST but are reads
+            if method.upper() in WRITE_METHODS and self.resource(url) != 'graphql':
+                delay = max(delay, self.next_write - now)
+                self.next_write = now + delay + self.seconds_between_writes
+        if delay > 0:
+            time.sleep(delay)
+
+    def update_budget(self, response):
+        """Record the budget left, as reported by a response."""
+        headers = response.headers
+        if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+            resource = headers.get('X-RateLimit-Resource', self.resource(response.url))
+            with self.lock:
+                self.budgets[resource] = (int(headers['X-RateLimit-Remaining']), int(headers['X-RateLimit-Reset']))
+
+    @staticmethod
+    def rate_limit_delay(response):
+        """Seconds to wait before retrying a rate limited request, or None if it was not."""
+        if response.status_code not in (403, 429):
+            return None
+        if 'Retry-After' in response.headers:
+            return float(response.headers['Retry-After'])
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return max(int(response.headers['X-RateLimit-Reset']) - time.time(), 0) + 1
+        if 'rate limit' in response.text.lower():
+            # Secondary rate limits without any hint, as advised by GitHub
+            return 60
+        return None
+
+    def cache_key(self, method, url, params=None):
+        """Key of the cached response of a request, or None if not cacheable."""
+        if not self.cache_path or method.upper() != 'GET':
+            return None
+        prepared = requests.Request(method, url, params=params).prepare()
+        # Responses depend on the credentials and the requested media type
+        identity = [prepared.url, self.headers.get('Authorization', ''), self.headers['Accept']]
+        return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+    def load(self, key):
+        """Load a cached response, or None if there is none."""
+        if key and path.exists(path.join(self.cache_path, f'{key}.json')):
+            with open(path.join(self.cache_path, f'{key}.json')) as f:
+                return json.load(f)
+
+    def store(self, key, response):
+        """Cache a response, replacing the previous one atomically."""
+        os.makedirs(self.cache_path, exist_ok=True)
+        cached = {'etag': response.headers['ETag'], 'headers': dict(response.headers), 'body': response.text}
+        filepath = path.join(self.cache_path, f'{key}.json')
+        with open(f'{filepath}.{threading.get_ident()}.tmp', 'w') as f:
+            json.dump(cached, f)
+        os.replace(f'{filepath}.{threading.get_ident()}.tmp', filepath)
+
+    @staticmethod
+    def cached_response(not_modified, cached):
+        """Response rebuilt from the cache, for a request answered with 304."""
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(cached['headers'])
+        response._content = cached['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = not_modified.url
+        response.request = not_modified.request
+        return response
+
+
+class AsyncGithub(object):
+    """Asyncio client of the GitHub API for lookups and writes fanned out across repositories.
+
+    Requests go through a ``GithubSession``, so they share its connections,
+    cache and pacing, and run in threads, at most ``concurrency`` at once.
+    Writes remain spaced out by the session, as required by GitHub.
+    """
+    def __init__(self, session, concurrency=8):
+        self.session = session
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    async def request(self, method, url, **kwargs):
+        """Send a request from a thread and return the JSON of the response."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self.session.request(method, url, **kwargs))
+        response.raise_for_status()
+        return response.json()
+
+    async def create_pull(self, repository, title, body, head, base):
+        """Open a PR on ``organization/name`` and return it."""
+        return await self.request('POST', f'{API_URL}/repos/{repository}/pulls',
+                                  json={'title': title, 'body': body, 'head': head, 'base': base})
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2020 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Resumable journal of the runs across repositories."""
+
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from os import path
+
+
+class Journal(object):
+    """Append-only JSON lines record of the stages each repository went through.
+
+    Each line holds the ``repository``, the ``stage`` it completed (one of
+    cloned, analyzed, patched, committed, pushed, pr_opened, or checked for
+    pip2020), the ``time`` and the details of the stage. Lines are flushed to disk as they are recorded, so
+    that a run restarted after a crash with ``resume`` loads them and skips
+    the stages already completed. Otherwise a new journal is started, and the
+    previous one is kept aside, suffixed with the time it was last written
+    (e.g. ``journal.jsonl.20201120-183000``). Read as a whole, the journal is
+    the report of the run.
+
+    Without a path, the journal is only kept in memory.
+    Stages can be recorded from several threads at the same time.
+    """
+    def __init__(self, journal_path=None, resume=False):
+        self.path = journal_path
+        self.lock = threading.Lock()
+        self.entries = defaultdict(list)
+        if journal_path and path.exists(journal_path) and not resume:
+            written = time.strftime('%Y%m%d-%H%M%S', time.localtime(path.getmtime(journal_path)))
+            os.replace(journal_path, f'{journal_path}.{written}')
+        if journal_path and path.exists(journal_path):
+            with open(journal_path) as f:
+                for line in f:
+                    # A crash may have cut the last line short
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[(entry['repository'], entry['stage'])].append(entry)
+
+    def find(self, repository, stage, **details):
+        """Last entry of a completed stage of a repository having the given details, or None."""
+        for entry in reversed(self.entries.get((repository, stage), [])):
+            if all(entry.get(key) == value for key, value in details.items()):
+                return entry
+
+    def record(self, repository, stage, **details):
+        """Record that a repository completed a stage."""
+        entry = dict(details, repository=repository, stage=stage, time=time.time())
+        with self.lock:
+            self.entries[(repository, stage)].append(entry)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def report(self):
+        """Number of repositories having completed each stage."""
+        return Counter(stage for (_, stage), entries in self.entries.items() if entries)
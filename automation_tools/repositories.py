@@ -8,54 +8,274 @@
 
 """GitHub utilities."""
 
+import asyncio
 import os
 import shutil
 import subprocess
 import sys
+import time
 from os import path
 
 import pygit2
 
 from automation_tools import config
-from automation_tools.config import github
-from automation_tools.utils import execute
+from automation_tools.config import github, github_session
+from automation_tools.github_api import API_URL, AsyncGithub
+from automation_tools.utils import (execute, git_ssh_environment,
+                                    list_directory_names, run_command,
+                                    run_parallel)
+
+
+# Metadata of the repositories of an organization, with the presence of the
+# files telling which scripts apply to them
+INVENTORY_QUERY = """
+query($organization: String!, $cursor: String) {
+  organization(login: $organization) {
+    repositories(first: 100, after: $cursor, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        isArchived
+        pushedAt
+        defaultBranchRef { name }
+        travis: object(expression: "HEAD:.travis.yml") { id }
+        runTests: object(expression: "HEAD:run-tests.sh") { id }
+      }
+    }
+  }
+}
+"""
+
+
+def is_invenio_module(repository):
+    """Whether an inventoried repository is an invenio module."""
+    return repository['name'].startswith('invenio-')
+
+
+def is_active(repository):
+    """Whether an inventoried repository is not archived."""
+    return not repository['archived']
+
+
+def is_sparse_checkout(repository_path):
+    """Whether a local repository is a sparse checkout, see ``clone_repository``."""
+    try:
+        return pygit2.Repository(repository_path).config.get_bool('core.sparseCheckout')
+    except (pygit2.GitError, KeyError):
+        return False
 
 
 class GithubUtils(object):
     @staticmethod
-    def list_invenio_modules():
-        """List invenio modules by parsing inveniosoftware organization."""
-        organization = 'inveniosoftware'
-        try:
-            user = github.get_organization(organization)
-            invenio_repositories = [repository.name for repository in user.get_repos() \
-                                    if repository.name.startswith('invenio-')]
-            return invenio_repositories
+    def inventory(organization, *predicates):
+        """Iterate over the repositories of an organization matching all the predicates.
 
-        except:
-            print('Failed to process the request')
+        Each repository is a dict holding its ``name``, ``archived`` flag,
+        ``default_branch``, ``pushed_at`` time and whether it has a
+        ``.travis.yml`` (``has_travis``) and a ``run-tests.sh``
+        (``has_run_tests``) on its default branch. Repositories are fetched
+        with GraphQL, a hundred per request, and yielded as pages arrive.
+
+        GraphQL requires a token. Without ``config.github_token``, the REST
+        listing is used instead, and whether the files are present is
+        unknown (None).
+        """
+        if not config.github_token:
+            for item in github_session.get_pages(f'{API_URL}/orgs/{organization}/repos'):
+                repository = {
+                    'name': item['name'],
+                    'archived': item['archived'],
+                    'default_branch': item['default_branch'],
+                    'pushed_at': item['pushed_at'],
+                    'has_travis': None,
+                    'has_run_tests': None,
+                }
+                if all(predicate(repository) for predicate in predicates):
+                    yield repository
+            return
+
+        cursor = None
+        while True:
+            data = github_session.graphql(INVENTORY_QUERY, {'organization': organization, 'cursor': cursor})
+            repositories = data['organization']['repositories']
+            for node in repositories['nodes']:
+                repository = {
+                    'name': node['name'],
+                    'archived': node['isArchived'],
+                    'default_branch': (node['defaultBranchRef'] or {}).get('name'),
+                    'pushed_at': node['pushedAt'],
+                    'has_travis': node['travis'] is not None,
+                    'has_run_tests': node['runTests'] is not None,
+                }
+                if all(predicate(repository) for predicate in predicates):
+                    yield repository
+
+            if not repositories['pageInfo']['hasNextPage']:
+                return
+            cursor = repositories['pageInfo']['endCursor']
+
+    @staticmethod
+    def list_invenio_modules(archived=True):
+        """List invenio modules by parsing inveniosoftware organization."""
+        predicates = [is_invenio_module] if archived else [is_invenio_module, is_active]
+        return [repository['name'] for repository in GithubUtils.inventory('inveniosoftware', *predicates)]
 
     @staticmethod
     def list_organization_repositories(organization):
         """List repositories by parsing configured organization."""
-        try:
-            user = github.get_organization(organization)
-            invenio_repositories = [repository.name for repository in user.get_repos()]
-            return invenio_repositories
+        return [repository['name'] for repository in GithubUtils.inventory(organization)]
 
-        except:
-            print('Failed to process the request')
+    @staticmethod
+    def clone_repository(repository_name, local_repositories_path, timeout=None, retries=0, sparse_paths=None,
+                         mirror=False, reference=None):
+        """Clone a repository, retrying when the clone fails or times out.
+
+        If ``sparse_paths`` (gitignore-style patterns) are given, a blob-less
+        partial clone is made and only the matching files are checked out.
+
+        With ``mirror``, a bare mirror is made instead and ``sparse_paths`` is
+        ignored. If the ``reference`` repository exists, the objects they have
+        in common are borrowed from it through git alternates rather than
+        copied.
+        """
+        url_github = "https://github.com/inveniosoftware"
+        destination = path.join(local_repositories_path, repository_name)
+        commands = [["git", "clone", "--quiet", f"{url_github}/{repository_name}", destination]]
+        if mirror:
+            commands = [["git", "clone", "--quiet", "--mirror", f"{url_github}/{repository_name}", destination]]
+            if reference:
+                commands[0][3:3] = ["--reference-if-able", path.join(local_repositories_path, reference)]
+        elif sparse_paths:
+            commands = [
+                ["git", "clone", "--quiet", "--filter=blob:none", "--no-checkout",
+                 f"{url_github}/{repository_name}", destination],
+                ["git", "-C", destination, "sparse-checkout", "set", "--no-cone"] + list(sparse_paths),
+                ["git", "-C", destination, "checkout", "--quiet"],
+            ]
+
+        for attempt in range(retries + 1):
+            try:
+                for command in commands:
+                    run_command(command, timeout)
+                return
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                # Never leave a half-cloned repository behind
+                if path.exists(destination):
+                    shutil.rmtree(destination)
+                if attempt == retries:
+                    raise
 
     @staticmethod
-    def download_invenio_modules(repositories, local_repositories_path):
-        """Download all the invenio modules in a newly created subfolder."""
-        if path.exists(local_repositories_path):
+    def update_repository(repository_name, local_repositories_path, timeout=None):
+        """Fetch new objects of a cloned repository and fast-forward its master.
+
+        The refs of a mirror are all updated by the fetch itself.
+        """
+        git = ["git", "-C", path.join(local_repositories_path, repository_name)]
+
+        def run(*args):
+            return run_command(git + list(args), timeout).stdout.strip()
+
+        run("fetch", "--quiet", "--prune", config.destination)
+        if run("rev-parse", "--is-bare-repository") == "true":
+            return
+
+        upstream = f"{config.destination}/master"
+        if run("rev-parse", "--abbrev-ref", "HEAD") == "master":
+            run("merge", "--quiet", "--ff-only", upstream)
+        else:
+            # Fetching from the repository itself only accepts fast-forwards
+            run("fetch", "--quiet", ".", f"{upstream}:master")
+
+    @staticmethod
+    def download_invenio_modules(repositories, local_repositories_path, workers=None, timeout=None, retries=None,
+                                 sync=False, prune=False, sparse_paths=None):
+        """Download all the invenio modules in a newly created subfolder.
+
+        Repositories are cloned in parallel. A failing clone does not stop the
+        others; the names of the synced repositories and a mapping of the
+        failed ones to their error are returned.
+
+        In sync mode an existing folder is reused: repositories already cloned
+        are fetched and fast-forwarded and missing ones are cloned. If
+        ``prune`` is set, the local repositories that the organization
+        listing reports as archived, or no longer lists (deleted upstream), are
+        removed, unless they are part of ``repositories``. Any other local
+        repository is left untouched.
+
+        ``sparse_paths`` restricts new clones to the matching files, see
+        ``clone_repository``. Sparse checkouts and full clones are never mixed
+        in the same folder: syncing one kind into a folder holding the other
+        one raises.
+
+        In ``mirror`` storage mode, bare mirrors are cloned instead, the ones
+        listed in ``config.mirror_references`` after the mirror they borrow
+        objects from. A referenced mirror is never pruned while another one
+        still borrows from it.
+        """
+        if path.exists(local_repositories_path) and not sync:
             raise Exception("Folder already exists")
 
-        os.mkdir(local_repositories_path)
-        url_github = "https://github.com/inveniosoftware"
-        for repository_name in repositories:
-            pygit2.clone_repository(f"{url_github}/{repository_name}", f"{local_repositories_path}/{repository_name}")
+        workers = workers or config.clone_workers
+        timeout = timeout or config.clone_timeout
+        retries = config.clone_retries if retries is None else retries
+
+        if not path.exists(local_repositories_path):
+            os.mkdir(local_repositories_path)
+
+        mirror = config.storage_mode == 'mirror'
+        references = config.mirror_references if mirror else {}
+
+        existing = set(list_directory_names(local_repositories_path))
+        sparse = {repository_name for repository_name in existing
+                  if is_sparse_checkout(path.join(local_repositories_path, repository_name))}
+        if sparse_paths and not mirror and existing.difference(sparse):
+            raise Exception(f"{local_repositories_path} holds full clones, "
+                            f"use another folder for sparse checkouts")
+        if (not sparse_paths or mirror) and sparse:
+            raise Exception(f"{local_repositories_path} holds sparse checkouts, "
+                            f"use another folder for full clones")
+
+        if prune:
+            active = {repository['name'] for repository in GithubUtils.inventory(config.organization, is_active)}
+            kept = active.union(repositories, (references.get(repository_name) for repository_name in existing))
+            for repository_name in sorted(existing.difference(kept)):
+                print(f'Pruning {repository_name}')
+                shutil.rmtree(path.join(local_repositories_path, repository_name))
+                existing.remove(repository_name)
+
+        def download(repository_name):
+            if repository_name in existing:
+                GithubUtils.update_repository(repository_name, local_repositories_path, timeout)
+            else:
+                GithubUtils.clone_repository(repository_name, local_repositories_path, timeout, retries,
+                                             sparse_paths, mirror, references.get(repository_name))
+
+        # Referenced mirrors first, so that the others can borrow their objects
+        results, failed = run_parallel(download, [r for r in repositories if r not in references], workers)
+        for reference in set(references.values()):
+            if path.exists(path.join(local_repositories_path, reference)):
+                # Objects dropped from a referenced mirror by `fetch --prune` would still be borrowed
+                for setting in (["gc.auto", "0"], ["gc.pruneExpire", "never"]):
+                    subprocess.run(["git", "-C", path.join(local_repositories_path, reference), "config"] + setting,
+                                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        borrowing_results, borrowing_failed = run_parallel(download, [r for r in repositories if r in references],
+                                                           workers)
+        results.update(borrowing_results)
+        failed.update(borrowing_failed)
+        synced = [repository_name for repository_name in repositories if repository_name in results]
+        updated = existing.intersection(synced)
+
+        print(f'Synced {len(synced)} out of {len(repositories)} repositories '
+              f'({len(synced) - len(updated)} cloned, {len(updated)} updated)')
+        for repository_name, error in failed.items():
+            # git's first fatal error, or else the last line of its error output, tells why (e.g. a missing
+            # repository)
+            lines = (getattr(error, 'stderr', None) or '').strip().splitlines()
+            reason = [line for line in lines if line.startswith(('fatal:', 'error:'))][:1] or lines[-1:]
+            print(f'Failed to sync {repository_name}: {error}' + ''.join(f' ({line})' for line in reason))
+
+        return synced, failed
 
     @staticmethod
     def open_pr(gh_repository, title, body, branch, base):
@@ -73,6 +293,68 @@ class GithubUtils(object):
 
         return pr_opened
 
+    @staticmethod
+    def open_prs(pull_requests, concurrency=None, callback=None):
+        """Open many PRs at once.
+
+        ``pull_requests`` are dicts holding the ``repository`` name, in the
+        organization, and the ``title``, ``body``, ``head`` and ``base`` of
+        a PR. As for ``run_parallel``, the URLs of the opened PRs and the
+        errors of the failed ones are returned, by (repository, head), and
+        ``callback`` is called with each of them as soon as it is opened.
+        """
+        client = AsyncGithub(github_session, concurrency or config.github_concurrency)
+        opened = {}
+        failed = {}
+
+        async def open_pr(repository, title, body, head, base):
+            try:
+                pr = await client.create_pull(f'{config.organization}/{repository}', title, body, head, base)
+                opened[(repository, head)] = pr['html_url']
+            except Exception as e:
+                failed[(repository, head)] = e
+            else:
+                if callback:
+                    callback((repository, head), pr['html_url'])
+
+        async def open_all():
+            await asyncio.gather(*(open_pr(**pull_request) for pull_request in pull_requests))
+
+        asyncio.run(open_all())
+        return opened, failed
+
+    @staticmethod
+    def push_branches(branches, workers=None, callback=None):
+        """Push many branches at once and report the outcome and latency of each one.
+
+        ``branches`` are dicts holding the ``repository`` name and the
+        ``local_branch`` (or commit id) to push as its ``head`` branch. They
+        are pushed by a bounded pool of workers, over SSH connections shared
+        by all the pushes to the same host.
+
+        The seconds each successful push took, and the errors of the failed
+        ones, are returned by (repository, head). ``callback`` is called with
+        each of them as soon as it is pushed.
+        """
+        branches = {(branch['repository'], branch['head']): branch for branch in branches}
+
+        def push(key):
+            branch = branches[key]
+            repo = LocalRepository(branch['repository'])
+            start = time.monotonic()
+            if not repo.push(repo.push_destination(), branch['local_branch'], branch['head']):
+                raise Exception(f'Failed to push after {time.monotonic() - start:.1f}s')
+            return time.monotonic() - start
+
+        pushed, failed = run_parallel(push, list(branches), workers or config.push_workers, callback=callback)
+        for (repository, head), seconds in sorted(pushed.items()):
+            print(f'Pushed {repository} ({head}) in {seconds:.1f}s')
+        for (repository, head), error in sorted(failed.items()):
+            print(f'Failed to push {repository} ({head}): {error}')
+        print(f'Pushed {len(pushed)} out of {len(branches)} branches')
+
+        return pushed, failed
+
     @staticmethod
     def create_organization_repository(repository):
         """Creates a repository under the organization name."""
@@ -80,26 +362,70 @@ class GithubUtils(object):
         org.create_repo(repository)
 
 
+# Status letters of `git status -s`, for the index and the working tree
+INDEX_STATUS = [
+    (pygit2.GIT_STATUS_INDEX_NEW, 'A'),
+    (pygit2.GIT_STATUS_INDEX_MODIFIED, 'M'),
+    (pygit2.GIT_STATUS_INDEX_DELETED, 'D'),
+    (pygit2.GIT_STATUS_INDEX_RENAMED, 'R'),
+    (pygit2.GIT_STATUS_INDEX_TYPECHANGE, 'T'),
+]
+WORKTREE_STATUS = [
+    (pygit2.GIT_STATUS_WT_MODIFIED, 'M'),
+    (pygit2.GIT_STATUS_WT_DELETED, 'D'),
+    (pygit2.GIT_STATUS_WT_RENAMED, 'R'),
+    (pygit2.GIT_STATUS_WT_TYPECHANGE, 'T'),
+]
+
+
+def parse_status(line):
+    """Parse a `git status -s` line into a (status, path) entry."""
+    status, filepath = line.strip().split(None, 1)
+    return status, filepath
+
+
 class LocalRepository(object):
-    """Context for a local copy of a repository."""
-    def __init__(self, repository):
+    """Context for a local copy of a repository.
+
+    Git commands run with the repository path as their working directory,
+    the process-wide one is never changed, so that several repositories can
+    be processed at the same time from different threads.
+
+    With the ``pygit2`` backend, status, staging and commits are done
+    in-process instead of spawning git.
+
+    ``worktree`` works on a worktree of the repository, e.g. a disposable
+    one of its mirror, instead of the local repository itself.
+    """
+    def __init__(self, repository, backend=None, worktree=None):
         self.repository = repository
+        self.path = worktree or path.join(config.local_repositories_path, repository)
+        self.backend = backend or config.git_backend
 
     def __enter__(self):
-        self.previous_directory = os.getcwd()
-        os.chdir(path.join(config.local_repositories_path, self.repository))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        os.chdir(self.previous_directory)
+        pass
+
+    def status(self):
+        """List the modifications as sorted (status, path) entries."""
+        if self.backend == 'pygit2':
+            entries = []
+            for filepath, flags in pygit2.Repository(self.path).status().items():
+                if flags & pygit2.GIT_STATUS_WT_NEW:
+                    entries.append(('??', filepath))
+                elif not flags & pygit2.GIT_STATUS_IGNORED:
+                    index = ''.join(letter for flag, letter in INDEX_STATUS if flags & flag)
+                    worktree = ''.join(letter for flag, letter in WORKTREE_STATUS if flags & flag)
+                    entries.append((index + worktree, filepath))
+            return sorted(entries)
+
+        return sorted(parse_status(out) for out in execute(["git", "status", "-s"], cwd=self.path))
 
     def check_status(self, expected):
         """Check if modifications are the ones expected."""
-        outputs = []
-        for out in execute(["git", "status", "-s"]):
-            outputs.append(out.strip())
-
-        if outputs == expected:
+        if self.status() == sorted(parse_status(line) for line in expected):
             modifs_ok = True
 
         else:
@@ -109,28 +435,132 @@ class LocalRepository(object):
 
     def commit(self, message, extra_before=None, extra_after=None):
         """Commit if changes."""
+        if self.backend == 'pygit2':
+            return self.commit_in_process(message, extra_before)
+
         try:
-            subprocess.check_output(["git", "add", "."])
+            subprocess.check_output(["git", "add", "."], cwd=self.path)
             commit = ["git"]
             if extra_before:
                 commit.extend(extra_before)
             commit.extend(["commit", "-m", message])
             if extra_after:
                 commit.extend(extra_after)
-            subprocess.check_output(commit)
+            subprocess.check_output(commit, cwd=self.path)
             commited = True
         except:
             commited = False
 
         return commited
 
+    def commit_in_process(self, message, extra_before=None):
+        """Stage everything and commit with pygit2.
+
+        ``-c user.name=...`` and ``-c user.email=...`` options of
+        ``extra_before`` set the signature; other git options are ignored.
+        """
+        try:
+            repo = pygit2.Repository(self.path)
+            repo.index.add_all()
+            repo.index.write()
+            tree = repo.index.write_tree()
+            parents = [] if repo.head_is_unborn else [repo.head.target]
+            if parents and repo[parents[0]].tree_id == tree:
+                return False
+
+            signature = self.signature(repo, extra_before)
+            repo.create_commit('HEAD', signature, signature, message, tree, parents)
+            commited = True
+        except (pygit2.GitError, KeyError, ValueError):
+            commited = False
+
+        return commited
+
+    @staticmethod
+    def signature(repo, extra_before=None):
+        """Signature set by ``-c user.name=... -c user.email=...`` or the default one."""
+        extra_before = extra_before or []
+        settings = dict(value.split('=', 1) for option, value in zip(extra_before[::2], extra_before[1::2])
+                        if option == '-c')
+        if 'user.name' in settings and 'user.email' in settings:
+            return pygit2.Signature(settings['user.name'], settings['user.email'])
+        return repo.default_signature
+
+    def commit_objects(self, base, branch, transformations, message, extra_before=None, expected=None):
+        """Commit transformed files on top of a branch without a working tree.
+
+        ``transformations`` map file paths to functions returning the new
+        content of the file at ``base``. New blobs, trees and the commit are
+        written straight into the object database and ``branch`` is created
+        at the commit, so this works in bare repositories too. ``base`` may
+        also be a branch of the destination remote. The changed paths are
+        returned; nothing is committed if there are none.
+
+        An existing ``branch`` is never overwritten. If the changed paths are
+        not the ``expected`` ones, nothing is committed either.
+        """
+        repo = pygit2.Repository(self.path)
+        if f'refs/heads/{branch}' in repo.references:
+            raise Exception(f"Branch {branch} already exists in {self.repository}")
+        try:
+            parent = repo.revparse_single(base)
+        except KeyError:
+            parent = repo.revparse_single(f'{config.destination}/{base}')
+        parent = parent.peel(pygit2.Commit)
+
+        tree = parent.tree
+        changed = []
+        for filepath, transform in transformations.items():
+            entry = tree[filepath]
+            content = repo[entry.id].data.decode()
+            new_content = transform(content)
+            if new_content != content:
+                blob_id = repo.create_blob(new_content.encode())
+                tree = repo[self.replace_tree_entry(repo, tree, filepath.split('/'), blob_id, entry.filemode)]
+                changed.append(filepath)
+
+        if expected is not None and sorted(changed) != sorted(expected):
+            raise Exception("Please review modifications")
+
+        if changed:
+            signature = self.signature(repo, extra_before)
+            commit_id = repo.create_commit(None, signature, signature, message, tree.id, [parent.id])
+            repo.references.create(f'refs/heads/{branch}', commit_id)
+
+        return changed
+
+    @staticmethod
+    def replace_tree_entry(repo, tree, parts, oid, filemode):
+        """Write a copy of a tree where the entry at the path ``parts`` points to ``oid``."""
+        builder = repo.TreeBuilder(tree)
+        if len(parts) == 1:
+            builder.insert(parts[0], oid, filemode)
+        else:
+            subtree_id = LocalRepository.replace_tree_entry(repo, repo[tree[parts[0]].id], parts[1:], oid, filemode)
+            builder.insert(parts[0], subtree_id, pygit2.GIT_FILEMODE_TREE)
+        return builder.write()
+
+    def push_destination(self):
+        """Where branches are pushed: ``config.push_url`` or the destination remote."""
+        if config.push_url:
+            return config.push_url.format(organization=config.organization, repository=self.repository)
+        return config.destination
+
     def push(self, destination, local_branch, remote_branch, force=False):
-        """Push commited changes."""
+        """Push commited changes.
+
+        ``local_branch`` may also be a commit id. SSH connections are
+        multiplexed, see ``git_ssh_environment``.
+        """
         try:
-            push = ["git", "push", destination, local_branch + ':' + remote_branch]
+            if not remote_branch.startswith('refs/'):
+                remote_branch = f'refs/heads/{remote_branch}'
+            # Mirrors refuse to push refspecs unless mirroring is turned off
+            push = ["git", "-c", f"remote.{destination}.mirror=false",
+                    "push", destination, local_branch + ':' + remote_branch]
             if force:
                 push.extend(['--force'])
-            subprocess.check_output(push)
+            subprocess.check_output(push, cwd=self.path, env=git_ssh_environment())
             pushed = True
         except:
             pushed = False
@@ -146,24 +576,33 @@ class LocalRepository(object):
             committed = self.commit(message, commit_extra_before, commit_extra_after)
             if committed:
                 print("Has been committed")
-                pushed = self.push(config.destination, local_branch, remote_branch)
-                if not pushed:
-                    raise Exception("Failed to push")
-
-                if pushed and is_mode_pr:
-                    print("Has been pushed")
-                    gh_repository = github.get_repo(f"{config.organization}/{repository}")
-                    pr_opened = GithubUtils.open_pr(gh_repository, title, body, remote_branch, base)
-                    if pr_opened:
-                        print("PR has been opened")
-                    else:
-                        raise Exception("PR has not been opened")
+                self.publish(is_mode_pr, repository, local_branch, remote_branch, title, body, base)
             else:
                 raise Exception("Failed to commit")
 
         else:
             raise Exception("Please review modifications")
 
+    def publish(self, is_mode_pr, repository, local_branch, remote_branch, title, body, base):
+        """Push a committed branch and open its PR, if in PR mode."""
+        pushed = self.push(self.push_destination(), local_branch, remote_branch)
+        if not pushed:
+            raise Exception("Failed to push")
+
+        if pushed and is_mode_pr:
+            print("Has been pushed")
+            gh_repository = github.get_repo(f"{config.organization}/{repository}")
+            pr_opened = GithubUtils.open_pr(gh_repository, title, body, remote_branch, base)
+            if pr_opened:
+                print("PR has been opened")
+            else:
+                raise Exception("PR has not been opened")
+
+    def head(self):
+        """Id of the commit checked out."""
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=self.path,
+                                       universal_newlines=True).strip()
+
     def set_origin(self, new_origin_url):
         """Set a repository's origin."""
-        execute(["git", "remote", "set-url", config.destination, new_origin_url])
+        subprocess.check_output(["git", "remote", "set-url", config.destination, new_origin_url], cwd=self.path)
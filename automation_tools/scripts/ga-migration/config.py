@@ -11,3 +11,6 @@
 REPO_PATHS_TO_MIGRATE = ["../invenio-accounts-rest", "../invenio-i18n"]
 GA_TESTS_YAML_URL = "https://raw.githubusercontent.com/inveniosoftware/invenio-formatter/master/.github/workflows/tests.yml"
 GA_PYPI_PUBLISH_YAML_URL = "https://raw.githubusercontent.com/inveniosoftware/invenio-formatter/master/.github/workflows/pypi-release.yml"
+
+# Directory caching the compiled templates between runs (None to disable it)
+JINJA_BYTECODE_CACHE_PATH = None
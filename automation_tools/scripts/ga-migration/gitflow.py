@@ -1,27 +1,61 @@
+import asyncio
 import logging, pygit2
 import os
+import sys
 import main
-from github import Github
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from pygit2 import GIT_SORT_TOPOLOGICAL, GIT_SORT_REVERSE, Signature
 import subprocess
+import time
 import click
 
+# The GitHub clients, with their settings, and the journal are the ones of automation_tools
+sys.path.append(str(Path(__file__).resolve().parents[3]))
+from automation_tools import config as automation_config
+from automation_tools.journal import Journal
+from automation_tools.repositories import GithubUtils, is_active, is_invenio_module
+from automation_tools.utils import git_ssh_environment
+
 logging.basicConfig(level=logging.INFO)
 local_repositories_path = "./localrepos"
 GA_BRANCH_NAME = "ga-migration"
+url_github = "https://github.com/"
+org_name = "inveniosoftware"
 
 
-def fullgit(repository_name):
-    # Clone
-    url_github = "https://github.com/"
-    org_name = "inveniosoftware"
+def github_client():
+    """Return the GitHub client, shared by all the repositories.
+
+    Get an access token at https://github.com/settings/tokens/new
+    and set it as env variable
+    e.g. start the script as `GH_ACCESS_TOKEN=$TOKEN python gitflow.py`
+
+    Rate limited requests wait and are retried, and writes are spaced out
+    to stay below the secondary rate limits, as set in the `github_*`
+    settings of automation_tools/config.py.
+    """
+    if not automation_config.github_token:
+        raise Exception("Set the GH_ACCESS_TOKEN env variable")
+    return automation_config.github
+
 
-    # Setup GitHub
-    #  Get an access token at https://github.com/settings/tokens/new
-    #  and set it as env variable
-    #  e.g. start the script as `GH_ACCESS_TOKEN=$TOKEN python gitflow.py`
-    g = Github(os.environ["GH_ACCESS_TOKEN"])
+def pending_repositories():
+    """
+    Names of the active invenio modules still having a .travis.yml
 
+    The whole organization is listed in a few GraphQL requests, so that
+    archived or already migrated repositories are skipped before cloning.
+    """
+    # Without a token, the inventory cannot tell which repositories have a .travis.yml
+    github_client()
+    for repository in GithubUtils.inventory(org_name, is_invenio_module, is_active):
+        if repository["has_travis"]:
+            yield repository["name"]
+
+
+def clone(repository_name):
+    """Clone the repository and branch from its last Travis CI commit."""
     # TODO: Check if folder already exists
     logging.info(f"Cloning {url_github}{org_name}/{repository_name}..")
 
@@ -30,15 +64,11 @@ def fullgit(repository_name):
         f"{local_repositories_path}/{repository_name}",
     )
 
-    gh_repo = g.get_repo(f"{org_name}/{repository_name}")
-
-    # Walk commits
+    # Walk commits, looking for .travis.yml in their tree objects
+    #  instead of checking each of them out
     for commit in repo.walk(repo.head.target, GIT_SORT_TOPOLOGICAL):
-        repo.checkout_tree(commit)
-        logging.info(f"Checking out {commit.tree_id}")
-        if os.path.isfile(
-            f"{local_repositories_path}/{repository_name}/.travis.yml"
-        ):
+        logging.info(f"Looking into {commit.id}")
+        if ".travis.yml" in commit.tree:
             print("found .travis.yml")
             break
 
@@ -48,6 +78,7 @@ def fullgit(repository_name):
     #  and update GA_BRANCH_NAME
     repo.branches.local.create(GA_BRANCH_NAME, commit)
 
+    # Only the found commit is checked out
     subprocess.run(
         f"git checkout {GA_BRANCH_NAME}",
         shell=True,
@@ -55,9 +86,14 @@ def fullgit(repository_name):
         cwd=f"{local_repositories_path}/{repository_name}",
     )
 
-    # Apply the patches
+
+def patch(repository_name):
+    """Apply the migration patches."""
     main.migrate_repo(f"{local_repositories_path}/{repository_name}")
 
+
+def commit(repository_name):
+    """Commit the migration on the ga-migration branch."""
     # git add .
     subprocess.run(
         f"git add .",
@@ -75,6 +111,9 @@ def fullgit(repository_name):
         cwd=f"{local_repositories_path}/{repository_name}",
     )
 
+
+def push(repository_name):
+    """Push the migration to the ga-migration branch."""
     # Switch from the HTTPS remote to the SSH one,
     #  to allow non-interactive passwordless push if a key is available
     #  TODO: just clone from the SSH origin from the beginning
@@ -85,17 +124,29 @@ def fullgit(repository_name):
         cwd=f"{local_repositories_path}/{repository_name}",
     )
 
-    # Push the new ga-migration branch
+    # Push the new ga-migration branch, reusing the SSH connection
+    #  of the previous pushes instead of a new handshake
+    #  (see the ssh_control_* settings of automation_tools/config.py)
     logging.info(f"Pushing branch '{GA_BRANCH_NAME}'")
     subprocess.run(
         f"git push --set-upstream origin ga-migration",
         shell=True,
         check=True,
         cwd=f"{local_repositories_path}/{repository_name}",
+        env=git_ssh_environment(),
     )
 
-    # Look for the GA-migration issue
-    open_issues = gh_repo.get_issues(state="open")
+
+def open_pr(repository_name):
+    """Open the migration Pull Request, linked to the migration issue."""
+    g = github_client()
+    gh_repo = g.get_repo(f"{org_name}/{repository_name}")
+
+    # Look for the GA-migration issue, searched server-side
+    #  instead of listing every open issue
+    open_issues = g.search_issues(
+        f'repo:{org_name}/{repository_name} is:issue is:open in:title "migration to"'
+    )
     number = 0
     for issue in open_issues:
         if (
@@ -124,10 +175,146 @@ def fullgit(repository_name):
     logging.info(f"Created Pull Request on GitHub {pr}")
 
 
+# Stages of the pipeline, in order, named as the stages they record in the journal
+STAGES = [
+    ("cloned", clone),
+    ("patched", patch),
+    ("committed", commit),
+    ("pushed", push),
+    ("pr_opened", open_pr),
+]
+
+
+def fullgit(repository_name):
+    for _, stage in STAGES:
+        stage(repository_name)
+
+
+async def run_batch(repository_names, limits, journal=None):
+    """
+    Run the pipeline on several repositories
+
+    Each stage runs in a thread, with at most limits[stage] repositories
+    in that stage at the same time, so that stages of different repositories
+    overlap. A failing repository does not stop the others.
+
+    Each completed stage is recorded in the journal, if any, and the stages
+    it already records are skipped.
+
+    :return: The error of each failed repository, and the seconds each
+        stage took for each repository, by repository name.
+    """
+    loop = asyncio.get_running_loop()
+    semaphores = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+    executor = ThreadPoolExecutor(max_workers=sum(limits.values()))
+    errors = dict()
+    timings = dict()
+
+    async def process(repository_name):
+        for name, stage in STAGES:
+            if journal and journal.find(repository_name, name):
+                continue
+            async with semaphores[name]:
+                start = time.monotonic()
+                try:
+                    await loop.run_in_executor(executor, stage, repository_name)
+                except Exception as e:
+                    logging.error(f"{repository_name} failed at {name}: {e}")
+                    errors[repository_name] = f"{name}: {e}"
+                    return
+                finally:
+                    timings.setdefault(repository_name, {})[name] = (
+                        time.monotonic() - start
+                    )
+            if journal:
+                journal.record(
+                    repository_name, name, seconds=timings[repository_name][name]
+                )
+
+    with executor:
+        await asyncio.gather(*(process(name) for name in repository_names))
+    return errors, timings
+
+
 @click.command()
-@click.option("--reponame", help="Repository name")
-def pipeline(reponame):
-    fullgit(reponame)
+@click.option("--reponame", multiple=True, help="Repository name (repeatable)")
+@click.option(
+    "--reponames-file",
+    type=click.File(),
+    help="File with one repository name per line",
+)
+@click.option(
+    "--all-pending",
+    is_flag=True,
+    help="Add every active module of the organization still using Travis CI",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    default="ga-migration-journal.jsonl",
+    help="File recording the stages completed by each repository",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip the stages the journal records as completed by the interrupted batch",
+)
+@click.option("--clone-jobs", default=4, help="Repositories cloned at once")
+@click.option("--patch-jobs", default=2, help="Repositories patched at once")
+@click.option("--commit-jobs", default=4, help="Repositories committed at once")
+@click.option("--push-jobs", default=4, help="Repositories pushed at once")
+@click.option("--pr-jobs", default=2, help="Pull Requests opened at once")
+def pipeline(
+    reponame,
+    reponames_file,
+    all_pending,
+    journal_path,
+    resume,
+    clone_jobs,
+    patch_jobs,
+    commit_jobs,
+    push_jobs,
+    pr_jobs,
+):
+    repository_names = list(reponame)
+    if reponames_file:
+        repository_names.extend(
+            line.strip() for line in reponames_file if line.strip()
+        )
+    if all_pending:
+        repository_names.extend(
+            name for name in pending_repositories() if name not in repository_names
+        )
+
+    limits = {
+        "cloned": clone_jobs,
+        "patched": patch_jobs,
+        "committed": commit_jobs,
+        "pushed": push_jobs,
+        "pr_opened": pr_jobs,
+    }
+    journal = Journal(journal_path, resume)
+    errors, timings = asyncio.run(run_batch(repository_names, limits, journal))
+
+    for repository_name in repository_names:
+        if "pushed" in timings.get(repository_name, {}):
+            outcome = "failed" if errors.get(repository_name, "").startswith("pushed:") else "pushed"
+            click.echo(
+                f"{repository_name}: {outcome} in {timings[repository_name]['pushed']:.1f}s"
+            )
+
+    click.secho(
+        f"\n{len(repository_names) - len(errors)} out of {len(repository_names)} repositories migrated",
+        fg="green",
+    )
+    for repository_name, error in errors.items():
+        click.secho(f"{repository_name} failed at {error}", fg="red")
+    click.echo(
+        "Journal: "
+        + ", ".join(f"{count} {stage}" for stage, count in journal.report().items())
+    )
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
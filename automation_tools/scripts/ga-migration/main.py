@@ -3,16 +3,9 @@ import requests
 import logging
 
 from utils import (
-    replace_regex,
-    replace_simple,
-    replace_list,
+    EditSession,
     read_yaml,
     download_file,
-    delete_line,
-    file_contains,
-    append_to_file,
-    add_line,
-    delete_file,
     render_template,
     build_template,
 )
@@ -49,91 +42,91 @@ def migrate_repo(path):
     except Exception as e:
         logging.info(f"Couldn't find deploy key in .travis.yml")
 
-    # .editorconfig
-    replace_simple(
-        path + ".travis.yml", ".github/workflows/*.yml", ".editorconfig"
-    )
-
-    # README.rst
-    replace_regex(
-        r"https:\/\/img\.shields\.io\/travis\/([a-z]*\/[a-z-]*)\.svg",
-        "https://github.com/\\1/workflows/CI/badge.svg",
-        path + "README.rst",
-    )
-    replace_regex(
-        r"https:\/\/travis-ci\.org\/([a-z]*\/[a-z-]*)",
-        "https://github.com/\\1/actions?query=workflow%3ACI",
-        path + "README.rst",
-    )
-
-    # CONTRIBUTING.rst
-    replace_regex(
-        r"https:\/\/travis-ci\.(org|com)\/([a-z]*\/[a-z-]*)\/pull_requests",
-        "https://github.com/\\2/actions?query=event%3Apull_request",
-        path + "CONTRIBUTING.rst",
-    )
-
-    # tests.yaml
-    build_template(repo, "tests.yml", path=f"{path}/.github/workflows")
-    # run-tests.sh
-    build_template(repo, "run-tests.sh", path=path)
-
-    # pytest.ini
-    delete_line("pep8ignore", path + "pytest.ini")
-    replace_regex(
-        "(addopts =).*",
-        f'\\1 --isort --pydocstyle --pycodestyle --doctest-glob="*.rst" --doctest-modules --cov={repo_underscores} --cov-report=term-missing',
-        path + "pytest.ini",
-    )
-    if not file_contains("testpaths", path + "pytest.ini"):
-        append_to_file(
-            f"testpaths = tests {repo_underscores}", path + "pytest.ini"
+    with EditSession(path) as session:
+        # .editorconfig
+        session.replace_simple(
+            ".travis.yml", ".github/workflows/*.yml", ".editorconfig"
         )
 
-    # Add .github/workflows *.yml to MANIFEST.in
-    add_line(
-        "recursive-include .github/workflows *.yml\n", path + "MANIFEST.in"
-    )
-
-    # Delete travis file
-    delete_file(path + ".travis.yml")
-
-    # Upgrade Sphinx 1 to 3 in setup.py
-    replace_regex(
-        r"Sphinx>=1.[0-9].[0-9]",
-        "Sphinx>=3",
-        path + "setup.py",
-    )
-
-    # Simplify setup.py test requirements replacing them with pytest-invenio
-    replace_list(
-        path + "setup.py",
-        r"tests_require = (['\"\'[\s*\"(a-z-A-Z><=0-9.\[\]),]*])",
-        [
-            # Remove packages already installed by pytest-invenio
-            "check-manifest",
-            "coverage",
-            "docker-services-cli",
-            "pytest-celery",
-            "pytest-cov",
-            "pytest-flask",
-            "pytest-isort",
-            "pytest-pycodestyle",
-            "pytest-pydocstyle",
-            "pydocstyle",
-            "pytest",
-            "selenium",
-            # pytest-pep8 is replaced by pytest-pycodestyle
-            "pytest-pep8",
-            # pytest-pep8 is replaced by pytest-isort
-            "isort",
-        ],
-        ["pytest-invenio>=1.4.0"],
-        "tests_require",
-    )
-
-    # Remove bak files
-    delete_file(path + "*.bak")
+        # README.rst
+        session.replace_regex(
+            r"https:\/\/img\.shields\.io\/travis\/([a-z]*\/[a-z-]*)\.svg",
+            "https://github.com/\\1/workflows/CI/badge.svg",
+            "README.rst",
+        )
+        session.replace_regex(
+            r"https:\/\/travis-ci\.org\/([a-z]*\/[a-z-]*)",
+            "https://github.com/\\1/actions?query=workflow%3ACI",
+            "README.rst",
+        )
+
+        # CONTRIBUTING.rst
+        session.replace_regex(
+            r"https:\/\/travis-ci\.(org|com)\/([a-z]*\/[a-z-]*)\/pull_requests",
+            "https://github.com/\\2/actions?query=event%3Apull_request",
+            "CONTRIBUTING.rst",
+        )
+
+        # tests.yaml
+        build_template(
+            repo, "tests.yml", path=f"{path}/.github/workflows", repo_path=path
+        )
+        # run-tests.sh
+        build_template(repo, "run-tests.sh", path=path, repo_path=path)
+
+        # pytest.ini
+        session.delete_line("pep8ignore", "pytest.ini")
+        session.replace_regex(
+            "(addopts =).*",
+            f'\\1 --isort --pydocstyle --pycodestyle --doctest-glob="*.rst" --doctest-modules --cov={repo_underscores} --cov-report=term-missing',
+            "pytest.ini",
+        )
+        if not session.file_contains("testpaths", "pytest.ini"):
+            session.append_to_file(
+                f"testpaths = tests {repo_underscores}", "pytest.ini"
+            )
+
+        # Add .github/workflows *.yml to MANIFEST.in
+        session.add_line(
+            "recursive-include .github/workflows *.yml\n", "MANIFEST.in"
+        )
+
+        # Delete travis file
+        session.delete_file(".travis.yml")
+
+        # Upgrade Sphinx 1 to 3 in setup.py
+        session.replace_regex(
+            r"Sphinx>=1.[0-9].[0-9]",
+            "Sphinx>=3",
+            "setup.py",
+        )
+
+        # Simplify setup.py test requirements replacing them with pytest-invenio
+        session.replace_list(
+            "setup.py",
+            r"tests_require = (['\"\'[\s*\"(a-z-A-Z><=0-9.\[\]),]*])",
+            [
+                # Remove packages already installed by pytest-invenio
+                "check-manifest",
+                "coverage",
+                "docker-services-cli",
+                "pytest-celery",
+                "pytest-cov",
+                "pytest-flask",
+                "pytest-isort",
+                "pytest-pycodestyle",
+                "pytest-pydocstyle",
+                "pydocstyle",
+                "pytest",
+                "selenium",
+                # pytest-pep8 is replaced by pytest-pycodestyle
+                "pytest-pep8",
+                # pytest-pep8 is replaced by pytest-isort
+                "isort",
+            ],
+            ["pytest-invenio>=1.4.0"],
+            "tests_require",
+        )
 
 
 @click.command()
@@ -1,53 +1,103 @@
 import logging
-import fileinput
 import glob
 import re
 import os
 import ast
 import json
-import subprocess
+from functools import lru_cache
 
+import pygit2
 import requests
 import yaml
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from config import JINJA_BYTECODE_CACHE_PATH
 
 
 logging.basicConfig(level=logging.INFO)
 
+
+def bytecode_cache():
+    """Return the on-disk cache of compiled templates, if configured."""
+    if JINJA_BYTECODE_CACHE_PATH:
+        os.makedirs(JINJA_BYTECODE_CACHE_PATH, exist_ok=True)
+        return FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_PATH)
+
+
 JinjaEnv = Environment(
     loader=FileSystemLoader(
         f"{os.path.join(os.path.dirname(__file__))}/templates"
-    )
+    ),
+    bytecode_cache=bytecode_cache(),
 )
 
+# Templates compiled once at startup
+Templates = {name: JinjaEnv.get_template(name) for name in JinjaEnv.list_templates()}
 
-def get_repo_services(repo_name):
-    """Get repository services."""
 
-    def _grep_url(grep_options, term, url):
-        """
-        Perform grep operation against content hosted under URL.
+# Services of the repositories, detected once per run
+repo_services_cache = dict()
 
-        :return: Whether term matches.
-        """
-        return not bool(
-            subprocess.call(
-                f'grep {grep_options} -- "{term}" <(curl -s {url})',
-                shell=True,
-                executable="/bin/bash",
-            )
-        )
 
-    repo_master_raw_url = (
-        f"https://raw.githubusercontent.com/inveniosoftware/{repo_name}/master"
-    )
-    travis_raw_url = f"{repo_master_raw_url}/.travis.yml"
-    is_migrated = not requests.get(travis_raw_url).ok
+def read_local_file(repo_path, filename):
+    """
+    Return the content of a file of a local repository, or None if it does
+    not exist. Bare repositories are read from the git objects of their HEAD.
+    """
+    filepath = os.path.join(repo_path, filename)
+    if os.path.isfile(filepath):
+        with open(filepath) as f:
+            return f.read()
+
+    try:
+        repo = pygit2.Repository(repo_path)
+        if repo.is_bare:
+            return repo.revparse_single(f"HEAD:{filename}").data.decode()
+    except (pygit2.GitError, KeyError):
+        pass
+
+
+def match_services(content, search_terms):
+    """Match all the search terms against the lines of the content at once."""
+    services = {service: False for service in search_terms.values()}
+    for line in content.splitlines():
+        for pattern, service in search_terms.items():
+            if not services[service] and pattern.search(line):
+                services[service] = True
+    return services
+
 
-    if is_migrated:
+def get_repo_services(repo_name, repo_path=None):
+    """
+    Get repository services.
+
+    The local clone at repo_path is looked at first: the upstream files are
+    only fetched if it has neither .travis.yml nor run-tests.sh. Services are
+    detected once per repository and run.
+    """
+    if repo_name in repo_services_cache:
+        return dict(repo_services_cache[repo_name])
+
+    travis = run_tests = None
+    if repo_path:
+        travis = read_local_file(repo_path, ".travis.yml")
+        if travis is None:
+            run_tests = read_local_file(repo_path, "run-tests.sh")
+
+    if travis is None and run_tests is None:
+        repo_master_raw_url = (
+            f"https://raw.githubusercontent.com/inveniosoftware/{repo_name}/master"
+        )
+        response = requests.get(f"{repo_master_raw_url}/.travis.yml")
+        if response.ok:
+            travis = response.text
+        else:
+            response = requests.get(f"{repo_master_raw_url}/run-tests.sh")
+            run_tests = response.text if response.ok else ""
+
+    if travis is None:
         logging.info("TASK: Repo already migrated, rechecking services...")
-        grep_options = "-qE"
-        url = f"{repo_master_raw_url}/run-tests.sh"
+        content = run_tests
         search_terms = {
             r"docker-services-cli up .*(DB|postgresql)": "db",
             r"docker-services-cli up .*(CACHE|redis)": "cache",
@@ -56,23 +106,27 @@ def get_repo_services(repo_name):
         }
     else:
         logging.info("TASK: Repo not migrated, identifing services...")
-        grep_options = "-q"
-        url = travis_raw_url
+        content = travis
         search_terms = {
-            "postgres": "db",
-            "- redis": "cache",
-            "elasticsearch": "search",
-            "rabbitmq-server": "mq",
+            re.escape(term): service
+            for term, service in {
+                "postgres": "db",
+                "- redis": "cache",
+                "elasticsearch": "search",
+                "rabbitmq-server": "mq",
+            }.items()
         }
 
-    services = dict()
-    for term, service in search_terms.items():
-        services[service] = _grep_url(grep_options, term, url)
+    services = match_services(
+        content,
+        {re.compile(term): service for term, service in search_terms.items()},
+    )
     logging.info(f"TASK: Repo services identified: {services}")
-    return services
+    repo_services_cache[repo_name] = services
+    return dict(services)
 
 
-def build_template(repo_name, template, path="."):
+def build_template(repo_name, template, path=".", repo_path=None):
     """Build template based on repo services."""
 
     def create_file(content, destination):
@@ -80,26 +134,40 @@ def build_template(repo_name, template, path="."):
         dirname = os.path.dirname(os.path.realpath(destination))
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        open(destination, "w").write(content)
+        with open(destination, "w") as f:
+            f.write(content)
 
-    repo_services = get_repo_services(repo_name)
+    repo_services = get_repo_services(repo_name, repo_path)
     has_services = any(repo_services.values())
     logging.info(f"TASK: Building and copying {template} template...")
 
     directory = "services" if has_services else "serviceless"
 
-    content = render_template(f"{directory}/{template}", context=repo_services)
+    content = render_services_template(
+        f"{directory}/{template}", tuple(sorted(repo_services.items()))
+    )
     destination = f"{path}/{template}"
     create_file(content, destination)
 
 
 def render_template(template_file, context={}):
     """Return string content of specified template file."""
-    template = JinjaEnv.get_template(template_file)
+    template = Templates.get(template_file) or JinjaEnv.get_template(template_file)
     output_from_parsed_template = template.render(**context)
     return output_from_parsed_template
 
 
+@lru_cache(maxsize=None)
+def render_services_template(template_file, services):
+    """
+    Return string content of specified template file for given services
+
+    Services are a tuple of (service, enabled) pairs, so that each
+    combination is only rendered once per template.
+    """
+    return render_template(template_file, context=dict(services))
+
+
 def delete_file(filepath):
     """
     If a file exists, delete it
@@ -116,20 +184,8 @@ def delete_file(filepath):
 
 def delete_line(term, filepath):
     """Delete file line contaning given term."""
-    logging.info(f"TASK: Deleting line containing {term} in {filepath}")
-    # import wdb; wdb.set_trace()
-    if not os.path.isfile(filepath):
-        logging.info("No %s found" % filepath)
-    else:
-        logging.info("Found %s" % filepath)
-        with open(filepath, "r") as f:
-            lines = f.readlines()
-        with open(filepath, "w") as f:
-            for line in lines:
-                if term not in line:
-                    f.write(line)
-                else:
-                    logging.info(f"TASK: Line deleted")
+    with EditSession(os.path.dirname(filepath)) as session:
+        return session.delete_line(term, os.path.basename(filepath))
 
 
 def file_contains(term, filepath):
@@ -143,59 +199,30 @@ def file_contains(term, filepath):
 
 def append_to_file(text, filepath):
     """Append text to file."""
-    if not os.path.isfile(filepath):
-        logging.info("No %s found" % filepath)
-    else:
-        with open(filepath, "a") as f:
-            f.write(text)
+    with EditSession(os.path.dirname(filepath)) as session:
+        session.append_to_file(text, os.path.basename(filepath))
 
 
 def add_line(term, filepath):
     """ Add a line to a file """
-    logging.info("TASK: Adding line '%s' to %s" % (term, filepath))
-    # If the file exists
-    if os.path.isfile(filepath):
-        # And the line is not already there
-        if not file_contains(term, filepath):
-            append_to_file(term, filepath)
-        else:
-            logging.info("SKIPPED TASK. Line already there. ")
-    else:
-        logging.info("SKIPPED TASK. No %s found" % filepath)
+    with EditSession(os.path.dirname(filepath)) as session:
+        session.add_line(term, os.path.basename(filepath))
 
 
 def replace_simple(text, replacing, filepath):
     """
     Replaces every match of a string with another in the specified file
     """
-    logging.info(
-        "TASK: Simple replacing %s with %s in %s" % (text, replacing, filepath)
-    )
-    if os.path.isfile(filepath):
-        logging.info("Found %s" % filepath)
-        # TODO: expose number of matches
-        with fileinput.FileInput(filepath, inplace=True, backup=".bak") as file:
-            for line in file:
-                print(line.replace(text, replacing), end="")
-    else:
-        logging.info("No %s found" % filepath)
+    with EditSession(os.path.dirname(filepath)) as session:
+        return session.replace_simple(text, replacing, os.path.basename(filepath))
 
 
 def replace_regex(regex, output, filepath):
     """
     Replaces every match of a string with another in the specified file
     """
-    logging.info(
-        "TASK: RegEx replacing %s with %s in %s" % (regex, output, filepath)
-    )
-    if os.path.isfile(filepath):
-        logging.info("Found %s" % filepath)
-        # TODO: expose number of matches
-        with fileinput.FileInput(filepath, inplace=True, backup=".bak") as file:
-            for line in file:
-                print(re.sub(regex, output, line), end="")
-    else:
-        logging.info("SKIPPED TASK. No %s found" % filepath)
+    with EditSession(os.path.dirname(filepath)) as session:
+        return session.replace_regex(regex, output, os.path.basename(filepath))
 
 
 def download_file(url, destination):
@@ -215,59 +242,208 @@ def replace_list(filepath, regex, to_remove, to_add, var_name):
     - add the elements from the "to_add" list
     Write the changes to "var_name" variable in the original file
     """
+    with EditSession(os.path.dirname(filepath)) as session:
+        return session.replace_list(os.path.basename(filepath), regex, to_remove, to_add, var_name)
 
-    if os.path.isfile(filepath):
-        with open(filepath, "r") as f:
-            contents = f.read()
 
-        # Search the list in the file contents
-        m = re.search(regex, contents)
-
-        if not m:
-            logging.info("SKIPPED TASK. Couldn't match regex")
-            return
-
-        # Group 0 matches the whole assignment,
-        # We need the right part of the assignment (Group 1)
-        matched_list_str = m.group(1)
+def replace_list_in(contents, regex, to_remove, to_add, var_name):
+    """
+    Same as "replace_list" on the given python source, which is returned
+    with the new list, or None if "regex" does not match
+    """
+    # Search the list in the file contents
+    m = re.search(regex, contents)
+
+    if not m:
+        logging.info("SKIPPED TASK. Couldn't match regex")
+        return
+
+    # Group 0 matches the whole assignment,
+    # We need the right part of the assignment (Group 1)
+    matched_list_str = m.group(1)
+
+    # Deserialize it
+    parsed_list = ast.literal_eval(matched_list_str)
+
+    # Prepare the new list
+    new_list = []
+
+    for element in parsed_list:
+        # Look for the package name
+        pm = re.search(r"([0-9a-zA-Z-\[_\]]*)[><=]*", element)
+        # If it doesn't match with any of the stuff we want to remove,
+        #  add it to the new list
+        if pm.group(1) not in to_remove:
+            new_list.append(element)
+        else:
+            logging.info(f"Removed {element} from {var_name}")
 
-        # Deserialize it
-        parsed_list = ast.literal_eval(matched_list_str)
+    for el_to_add in to_add:
+        if el_to_add not in parsed_list:
+            new_list.append(el_to_add)
+            logging.info(f"Added {el_to_add} in {var_name}")
+        else:
+            logging.info(f"{el_to_add} already in {var_name}")
 
-        # Prepare the new list
-        new_list = []
+    # Reconstruct the python assignment of the variable, with the list value
+    #  Dump JSON with 4 spaces indent to keep setup.py formatted
+    #  Must be kept in-sync with the indent_size value in
+    #   .editorconfig / project setups
+    py_new_string = f"{var_name} = {json.dumps(new_list, indent=4)}"
 
-        for element in parsed_list:
-            # Look for the package name
-            pm = re.search(r"([0-9a-zA-Z-\[_\]]*)[><=]*", element)
-            # If it doesn't match with any of the stuff we want to remove,
-            #  add it to the new list
-            if pm.group(1) not in to_remove:
-                new_list.append(element)
-            else:
-                logging.info(f"Removed {element} from {var_name}")
+    # Replace the old (matched) list assignment with the one with the new contents
+    return contents.replace(m.group(0), py_new_string)
 
-        for el_to_add in to_add:
-            if el_to_add not in parsed_list:
-                new_list.append(el_to_add)
-                logging.info(f"Added {el_to_add} in {var_name}")
-            else:
-                logging.info(f"{el_to_add} already in {var_name}")
 
-        # Reconstruct the python assignment of the variable, with the list value
-        #  Dump JSON with 4 spaces indent to keep setup.py formatted
-        #  Must be kept in-sync with the indent_size value in
-        #   .editorconfig / project setups
-        py_new_string = f"{var_name} = {json.dumps(new_list, indent=4)}"
+class EditSession:
+    """
+    Edit the files of a repository in memory
 
-        # Replace the old (matched) list assignment with the one with the new contents
-        content2 = contents.replace(m.group(0), py_new_string)
+    Each file is read the first time an operation needs it, operations are
+    applied in the order they are called, and every modified file is
+    written (or deleted) once, on flush. Operations return their number of
+    matches.
+    """
 
-        # Overwrite the contents of the file
-        with open(filepath, "w") as f:
-            f.write(content2)
-    else:
-        logging.info("SKIPPED TASK. No %s found" % filepath)
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.modified = set()
+        self.deleted = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def lines(self, filename):
+        """Lines of a file, or None if it does not exist."""
+        if filename not in self.files:
+            filepath = os.path.join(self.path, filename)
+            if os.path.isfile(filepath):
+                logging.info("Found %s" % filepath)
+                with open(filepath, "r") as f:
+                    self.files[filename] = f.readlines()
+            else:
+                self.files[filename] = None
+        return self.files[filename]
+
+    def update(self, filename, lines):
+        """Replace the lines of a file."""
+        self.files[filename] = lines
+        self.modified.add(filename)
+
+    def replace_simple(self, text, replacing, filename):
+        """Replace every match of a string with another."""
+        logging.info(
+            "TASK: Simple replacing %s with %s in %s" % (text, replacing, filename)
+        )
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("No %s found" % filename)
+            return 0
+        matches = sum(line.count(text) for line in lines)
+        if matches:
+            self.update(filename, [line.replace(text, replacing) for line in lines])
+        logging.info(f"{matches} matches")
+        return matches
+
+    def replace_regex(self, regex, output, filename):
+        """Replace every match of a regular expression, line by line."""
+        logging.info(
+            "TASK: RegEx replacing %s with %s in %s" % (regex, output, filename)
+        )
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("SKIPPED TASK. No %s found" % filename)
+            return 0
+        pattern = re.compile(regex)
+        matches = 0
+        new_lines = []
+        for line in lines:
+            new_line, count = pattern.subn(output, line)
+            new_lines.append(new_line)
+            matches += count
+        if matches:
+            self.update(filename, new_lines)
+        logging.info(f"{matches} matches")
+        return matches
+
+    def delete_line(self, term, filename):
+        """Delete the lines containing given term."""
+        logging.info(f"TASK: Deleting line containing {term} in {filename}")
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("No %s found" % filename)
+            return 0
+        kept = [line for line in lines if term not in line]
+        matches = len(lines) - len(kept)
+        if matches:
+            self.update(filename, kept)
+        logging.info(f"TASK: {matches} lines deleted")
+        return matches
+
+    def file_contains(self, term, filename):
+        """Check whether file contains given term."""
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("No %s found" % filename)
+            return False
+        return term in "".join(lines)
+
+    def append_to_file(self, text, filename):
+        """Append text to file."""
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("No %s found" % filename)
+            return 0
+        self.update(filename, lines + [text])
+        return 1
+
+    def add_line(self, term, filename):
+        """Add a line to a file, unless it is already there."""
+        logging.info("TASK: Adding line '%s' to %s" % (term, filename))
+        if self.lines(filename) is None:
+            logging.info("SKIPPED TASK. No %s found" % filename)
+            return 0
+        if self.file_contains(term, filename):
+            logging.info("SKIPPED TASK. Line already there. ")
+            return 0
+        return self.append_to_file(term, filename)
+
+    def replace_list(self, filename, regex, to_remove, to_add, var_name):
+        """See "replace_list"."""
+        lines = self.lines(filename)
+        if lines is None:
+            logging.info("SKIPPED TASK. No %s found" % filename)
+            return 0
+        contents = replace_list_in("".join(lines), regex, to_remove, to_add, var_name)
+        if contents is None:
+            return 0
+        self.update(filename, contents.splitlines(keepends=True))
+        return 1
+
+    def delete_file(self, filename):
+        """Delete a file on flush."""
+        logging.info("TASK: Deleting %s" % filename)
+        self.deleted.add(filename)
+        self.modified.discard(filename)
+        self.files[filename] = None
+
+    def flush(self):
+        """Write the modified files and remove the deleted ones."""
+        for filename in sorted(self.modified):
+            with open(os.path.join(self.path, filename), "w") as f:
+                f.write("".join(self.files[filename]))
+        for filename in sorted(self.deleted):
+            filepath = os.path.join(self.path, filename)
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+                logging.info("Deleted %s" % filepath)
+        self.modified.clear()
+        self.deleted.clear()
 
 
 def read_yaml(filepath):
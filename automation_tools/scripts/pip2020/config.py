@@ -11,11 +11,55 @@
 # Set the local path to install virtual environments
 local_virtualenvs_path = 'Virtualenvs'
 
+# Set the local path to write the installation logs of each repository
+local_logs_path = 'Logs'
+
+# Number of repositories installed at the same time (None to use all CPUs)
+workers = None
+
+# Seconds after which the installation of a repository is aborted
+install_timeout = 1800
+
+# Number of lines kept from the end of the output of each installation
+log_tail = 200
+
 # Set python version to create virtualenv
 python_version = 'python3.6'
 
-# Download locally the packages you want to test
+# Build one base virtualenv per python version and give each repository a
+# hardlinked copy of it, instead of creating every virtualenv from scratch
+base_virtualenv = True
+
+# Download locally the packages you want to test (refreshes an existing cache)
 download_locally = False
 
-# Use the new pip2020 resolver
+# Use the new pip2020 resolver (always used from pip 20.3, where it is the
+# default)
 flag_2020 = True
+
+# Only run the resolver (`pip install --dry-run`, pip>=22.2) and report the
+# conflicting requirements, without building nor installing anything.
+# The 2020 resolver is then always used. pip is upgraded in the virtualenvs,
+# and the run stops early if it is still too old.
+resolve_only = False
+
+# Local wheelhouse the installations look into before the package index
+# (None to disable it). It is populated with the wheels of the dependencies
+# of all the repositories before checking them, unless running offline.
+wheelhouse_path = None
+
+# Resolve against the wheelhouse only, without reaching the package index
+offline = False
+
+# File keeping the results of the previous runs (None to disable it).
+# Repositories whose dependency files and settings did not change are not
+# checked again, unless the script is run with `--force`. Unless running
+# offline, the package index keeps changing, so results are kept for the
+# current (UTC) day only.
+results_cache_path = 'pip2020-results.json'
+
+# Journal of the result of each checked repository, one JSON line each (None
+# to disable it). Run the script with `--resume` to skip the repositories
+# checked by an interrupted run; otherwise a new journal is started (the
+# previous one is renamed after the time it was last written).
+journal_path = 'pip2020-journal.jsonl'
@@ -6,83 +6,410 @@
 # Invenio is free software; you can redistribute it and/or modify it
 # under the terms of the MIT License; see LICENSE file for more details.
 
+import argparse
+import fnmatch
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import tempfile
+from collections import Counter, deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 from os import path
 
 from automation_tools import config
-from automation_tools.repositories import GithubUtils
+from automation_tools.journal import Journal
+from automation_tools.repositories import GithubUtils, is_sparse_checkout
 from automation_tools.scripts.pip2020 import config as script_config
-from automation_tools.utils import execute
+from automation_tools.utils import (execute, list_repository_files,
+                                    read_repository_file, run_parallel)
+from automation_tools.worktrees import WorktreePool, repository_checkout
 
 
-def error_detector(repositories):
-    """Detect the invenio modules that require fixing."""
-    clean = []
-    need_fix = []
-    command_fails = []
+def build_base_virtualenv():
+    """Create, once, the pristine virtualenv of the configured python version.
 
-    if path.exists(script_config.local_virtualenvs_path):
-        shutil.rmtree(script_config.local_virtualenvs_path)
-    else:
-        os.mkdir(script_config.local_virtualenvs_path)
+    With ``resolve_only``, pip is upgraded in a base virtualenv of its own, so
+    that the other runs keep the pip bundled with the virtualenv.
+    """
+    name = f'base-{script_config.python_version}'
+    if script_config.resolve_only:
+        name = f'{name}-resolve-only'
+    base_path = path.join(script_config.local_virtualenvs_path, name)
+    if not path.exists(base_path):
+        # Build aside and rename, so that a concurrent run never sees it half-built
+        building_path = tempfile.mkdtemp(dir=script_config.local_virtualenvs_path)
+        subprocess.check_output(['virtualenv', '-p',
+                                 script_config.python_version, building_path])
+        if script_config.resolve_only:
+            upgrade_pip(path.join(building_path, 'bin', 'python'))
+        try:
+            os.rename(building_path, base_path)
+        except OSError:
+            shutil.rmtree(building_path)
 
-    for repository in repositories:
-        print(f'------- WORKING ON {repository} -------')
-        folder_repository = f'{script_config.local_virtualenvs_path}/{repository}'
-        os.mkdir(folder_repository)
+    return base_path
 
-        subprocess.check_output(['virtualenv', '-p',
-                                 script_config.python_version, folder_repository])
+
+def upgrade_pip(python):
+    """Upgrade pip in a virtualenv, keeping the bundled one if the index cannot be reached."""
+    subprocess.run([python, '-m', 'pip', 'install', '--quiet', '--upgrade', 'pip'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def pip_version(python):
+    """Version of the pip of a virtualenv, e.g. ``(22, 2)``."""
+    output = subprocess.check_output([python, '-m', 'pip', '--version'], universal_newlines=True)
+    return tuple(int(part) for part in output.split()[1].split('.')[:2] if part.isdigit())
+
+
+def link_or_copy(source, destination):
+    """Hardlink a file, copying it when hardlinks are not supported."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def is_resolver_conflict(line):
+    """Whether pip reported that the requirements cannot be satisfied together.
+
+    The 2020 resolver ends its report with ``ResolutionImpossible``, after
+    the conflicting requirements. The legacy resolver reports each conflict
+    before installing anything.
+    """
+    return line.startswith('ERROR: ResolutionImpossible') or line.rstrip().endswith('which is incompatible.')
+
+
+def parse_conflicts(outputs):
+    """Extract the conflicting requirements from the output of the pip resolver.
+
+    Errors of the subprocesses run by pip, such as build backends, are
+    indented and ignored.
+    """
+    conflicts = []
+    in_conflict = False
+    for line in outputs:
+        if line == 'The conflict is caused by:':
+            in_conflict = True
+        elif in_conflict and line:
+            conflicts.append(line.strip())
+        elif in_conflict:
+            in_conflict = False
+        elif line.startswith('ERROR: Could not find a version that satisfies') or \
+                line.endswith('which is incompatible.'):
+            conflicts.append(line[len('ERROR: '):] if line.startswith('ERROR: ') else line)
+
+    return conflicts
+
+
+def populate_wheelhouse(sources, python):
+    """Build into the wheelhouse the wheels of the dependencies of the repositories.
+
+    ``sources`` map the repositories to the paths they are checked out at.
+    The wheels of the repositories themselves are left out, so that the
+    installations keep resolving them against the package index.
+
+    Repositories are built in parallel, as many at a time as the
+    ``workers`` setting of the script allows. The wheels of a failed build
+    are all left out, and the failed repositories are reported and returned
+    along with their error.
+    """
+    wheelhouse_path = path.abspath(script_config.wheelhouse_path)
+    os.makedirs(wheelhouse_path, exist_ok=True)
+
+    def build(repository):
+        print(f'------- BUILDING WHEELS OF {repository} -------')
+        build_path = tempfile.mkdtemp(dir=script_config.local_virtualenvs_path)
         try:
-            outputs = []
-            if script_config.flag_2020:
-                command = [f'{folder_repository}/bin/pip',
-                           'install', f'Invenio clones/{repository}',
-                           '--use-feature=2020-resolver']
+            subprocess.run([python, '-m', 'pip', 'wheel', '--wheel-dir', build_path,
+                            '--find-links', wheelhouse_path, sources[repository]],
+                           check=True, timeout=script_config.install_timeout,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+            for wheel in os.listdir(build_path):
+                if wheel.split('-')[0].lower() != repository.replace('-', '_').lower():
+                    os.replace(path.join(build_path, wheel), path.join(wheelhouse_path, wheel))
+        finally:
+            shutil.rmtree(build_path)
+
+    _, failed = run_parallel(build, sources, script_config.workers)
+    for repository, error in sorted(failed.items()):
+        reason = error.stderr.strip().splitlines()[-1:] if getattr(error, 'stderr', None) else [str(error)]
+        print(f'Could not build the wheels of {repository}: {"".join(reason)}')
+    return failed
+
+
+def classify_download(line):
+    """Whether a pip output line shows a package taken from the wheelhouse or the network."""
+    if script_config.wheelhouse_path and line.startswith(f'Processing {path.abspath(script_config.wheelhouse_path)}'):
+        return 'hits'
+    if line.startswith(('Downloading ', 'Using cached ')):
+        return 'misses'
 
-            else:
-                command = [f'{folder_repository}/bin/pip',
-                           'install', f'Invenio clones/{repository}']
 
-            for out in execute(command):
-                outputs.append(out.strip())
+def check_repository(repository, sources, scratch_path, base_path=None):
+    """Install a repository in its own virtualenv and return its result.
 
-            if 'ERROR' in outputs:
-                need_fix.append(repository)
+    The result holds the status of the repository, the conflicting
+    requirements reported by pip and the number of packages taken from the
+    wheelhouse (hits) and from the network (misses).
 
-            else:
-                clean.append(repository)
+    pip is stopped as soon as it reports a resolver conflict, or after
+    ``install_timeout`` seconds, and only the last ``log_tail`` lines of its
+    output are kept.
 
-        except:
-            command_fails.append(repository)
+    If ``base_path`` is given, the virtualenv is a hardlinked copy of it
+    instead of a new one. Packages are always installed through
+    ``bin/python -m pip``, as the ``bin/pip`` script of a copy still points
+    to the interpreter of the base virtualenv.
 
+    The repository is installed from the path ``sources`` map it to, see
+    ``repository_checkout``.
+    """
+    print(f'------- WORKING ON {repository} -------')
+    folder_repository = tempfile.mkdtemp(prefix=f'{repository}-', dir=scratch_path)
+    try:
+        return install_repository(repository, sources[repository], folder_repository, base_path)
+
+    finally:
         shutil.rmtree(folder_repository)
 
-    return need_fix, clean, command_fails
+
+def install_repository(repository, source, folder_repository, base_path=None):
+    """Install the repository checked out at ``source`` in the virtualenv ``folder_repository``."""
+    if base_path:
+        shutil.copytree(base_path, folder_repository, symlinks=True,
+                        copy_function=link_or_copy, dirs_exist_ok=True)
+    else:
+        subprocess.check_output(['virtualenv', '-p',
+                                 script_config.python_version, folder_repository])
+        if script_config.resolve_only:
+            upgrade_pip(path.join(folder_repository, 'bin', 'python'))
+    command = [f'{folder_repository}/bin/python', '-m', 'pip', 'install', source]
+    if script_config.wheelhouse_path:
+        command.extend(['--find-links', path.abspath(script_config.wheelhouse_path)])
+    if script_config.offline:
+        command.append('--no-index')
+    if script_config.resolve_only:
+        # The 2020 resolver is the default of the pip versions having --dry-run
+        command.extend(['--dry-run', '--ignore-installed'])
+    elif script_config.flag_2020 and pip_version(f'{folder_repository}/bin/python') < (20, 3):
+        # The 2020 resolver is the default from pip 20.3, which rejects the flag
+        command.append('--use-feature=2020-resolver')
+
+    outputs = deque(maxlen=script_config.log_tail)
+    downloads = Counter()
+    try:
+        for out in execute(command, merge_stderr=True, until=is_resolver_conflict,
+                           timeout=script_config.install_timeout):
+            # Keep the indentation, it tells pip's own errors from the ones of its subprocesses
+            outputs.append(out.rstrip())
+            downloads[classify_download(outputs[-1].lstrip())] += 1
+
+        if outputs and is_resolver_conflict(outputs[-1]):
+            status = 'need_fix'
+
+        else:
+            status = 'clean'
+
+    except subprocess.CalledProcessError:
+        status = 'need_fix' if parse_conflicts(outputs) else 'command_fails'
+
+    except subprocess.TimeoutExpired:
+        status = 'command_fails'
+
+    with open(path.join(script_config.local_logs_path, f'{repository}.log'), 'w') as log:
+        log.write(os.linesep.join(outputs))
+
+    return {'status': status, 'conflicts': parse_conflicts(outputs),
+            'hits': downloads['hits'], 'misses': downloads['misses']}
+
+
+def index_snapshot():
+    """Identify the packages the installations resolve against.
+
+    Only an offline wheelhouse is a fixed set of packages; otherwise the
+    package index keeps changing, so it is identified by the current (UTC)
+    day and results are checked again the next day.
+    """
+    if not script_config.offline:
+        return 'index-' + datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    wheels = sorted(os.listdir(script_config.wheelhouse_path)) if script_config.wheelhouse_path else []
+    return hashlib.sha256('\n'.join(wheels).encode()).hexdigest()
+
+
+def fingerprint(repository, snapshot):
+    """Hash the dependency files of a repository along with the run settings."""
+    digest = hashlib.sha256()
+    settings = [script_config.python_version, script_config.flag_2020, script_config.resolve_only, snapshot]
+    digest.update(json.dumps(settings).encode())
+
+    filenames = ['setup.py', 'setup.cfg', 'pyproject.toml']
+    filenames.extend(fnmatch.filter(list_repository_files(repository), 'requirements*.txt'))
+    for filename in filenames:
+        content = read_repository_file(repository, filename)
+        if content is not None:
+            digest.update(filename.encode())
+            digest.update(content.encode())
+
+    return digest.hexdigest()
+
+
+def load_results_cache():
+    """Load the results of the previous runs."""
+    if script_config.results_cache_path and path.exists(script_config.results_cache_path):
+        with open(script_config.results_cache_path) as f:
+            return json.load(f)
+
+    return {}
+
+
+def save_results_cache(cache):
+    """Store the results of the runs, replacing the previous file atomically."""
+    if script_config.results_cache_path:
+        with open(f'{script_config.results_cache_path}.tmp', 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(f'{script_config.results_cache_path}.tmp', script_config.results_cache_path)
+
+
+def error_detector(repositories, force=False, journal=None):
+    """Detect the invenio modules that require fixing.
+
+    Repositories are installed in parallel, each one in a scratch virtualenv
+    private to this run. The result of each repository is returned along
+    with the buckets.
+
+    Unless ``force`` is set, repositories whose fingerprint did not change
+    since a previous run are not checked again; their result comes from the
+    results cache and is flagged as ``cached``.
+
+    The result of each repository is recorded in the ``journal`` as soon as
+    it is checked. Repositories the journal already records, with the same
+    fingerprint, are not checked again.
+    """
+    journal = journal or Journal()
+    clean = []
+    need_fix = []
+    command_fails = []
+
+    os.makedirs(script_config.local_virtualenvs_path, exist_ok=True)
+    os.makedirs(script_config.local_logs_path, exist_ok=True)
+
+    cache = load_results_cache()
+    snapshot = index_snapshot()
+    fingerprints = {repository: fingerprint(repository, snapshot) for repository in repositories}
+    # Results recorded by an interrupted run
+    checked = {repository: journal.find(repository, 'checked', fingerprint=fingerprints[repository])['result']
+               for repository in repositories
+               if journal.find(repository, 'checked', fingerprint=fingerprints[repository])}
+    results = {}
+    if not force:
+        results = {repository: dict(cache[repository]['result'], cached=True) for repository in repositories
+                   if repository not in checked
+                   and cache.get(repository, {}).get('fingerprint') == fingerprints[repository]}
+    to_check = [repository for repository in repositories if repository not in results and repository not in checked]
+
+    if to_check:
+        base_path = build_base_virtualenv() if script_config.base_virtualenv else None
+        if script_config.resolve_only:
+            version = pip_version(path.join(base_path or build_base_virtualenv(), 'bin', 'python'))
+            if version < (22, 2):
+                raise Exception(f"resolve_only needs pip>=22.2 (for --dry-run), the {script_config.python_version} "
+                                f"virtualenvs have pip {'.'.join(map(str, version))} and it could not be upgraded")
+        # Checked out once for the whole run, in mirror mode as worktrees of a single pool
+        with WorktreePool() as pool, ExitStack() as checkouts:
+            sources = {repository: checkouts.enter_context(repository_checkout(repository, pool=pool))
+                       for repository in to_check}
+            if script_config.wheelhouse_path and not script_config.offline:
+                populate_wheelhouse(sources, path.join(base_path or build_base_virtualenv(), 'bin', 'python'))
+            scratch_path = tempfile.mkdtemp(dir=script_config.local_virtualenvs_path)
+            try:
+                fresh, errors = run_parallel(partial(check_repository, sources=sources, scratch_path=scratch_path,
+                                                     base_path=base_path),
+                                             to_check, script_config.workers, ProcessPoolExecutor,
+                                             callback=lambda repository, result: journal.record(
+                                                 repository, 'checked', fingerprint=fingerprints[repository],
+                                                 result=result))
+            finally:
+                shutil.rmtree(scratch_path)
+        checked.update(fresh)
+        for repository, error in errors.items():
+            print(f'Failed to check {repository}: {error}')
+
+    for repository, result in checked.items():
+        results[repository] = dict(result, cached=False)
+        # Failures of the command itself may be transient, never keep them
+        if result['status'] != 'command_fails':
+            cache[repository] = {'fingerprint': fingerprints[repository], 'result': result}
+    if checked:
+        save_results_cache(cache)
+
+    buckets = {'need_fix': need_fix, 'clean': clean, 'command_fails': command_fails}
+    failed = {'status': 'command_fails', 'conflicts': [], 'hits': 0, 'misses': 0, 'cached': False}
+    for repository in repositories:
+        results.setdefault(repository, failed)
+        buckets[results[repository]['status']].append(repository)
+
+    return need_fix, clean, command_fails, results
+
+
+def describe(repository, result):
+    """Name of a repository, flagged when its result comes from the cache."""
+    return f'{repository} (cached)' if result['cached'] else repository
 
 
 def main():
     """."""
-    invenio_repositories = GithubUtils.list_invenio_modules()
+    parser = argparse.ArgumentParser(description='Detect the invenio modules failing to install.')
+    parser.add_argument('--force', action='store_true', help='check again the repositories having cached results')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the repositories the journal records as checked by the interrupted run')
+    args = parser.parse_args()
+    journal = Journal(script_config.journal_path, args.resume)
+
+    invenio_repositories = GithubUtils.list_invenio_modules(archived=False)
     if script_config.download_locally:
         GithubUtils.download_invenio_modules(invenio_repositories,
-                                             config.local_repositories_path)
+                                             config.local_repositories_path,
+                                             sync=True,
+                                             prune=config.prune_local_repositories)
+
+    sparse = [repository for repository in invenio_repositories
+              if is_sparse_checkout(path.join(config.local_repositories_path, repository))]
+    if sparse:
+        raise Exception(f"{config.local_repositories_path} holds sparse checkouts (e.g. {sparse[0]}), "
+                        f"installing the repositories needs full clones")
 
-    need_fix, clean, command_fails = error_detector(invenio_repositories)
+    need_fix, clean, command_fails, results = error_detector(invenio_repositories, args.force, journal)
 
     print("Following repositories have to be fixed")
     for repositories in need_fix:
-        print(repositories)
+        print(describe(repositories, results[repositories]))
+        for conflict in results[repositories]['conflicts']:
+            print(f'    {conflict}')
 
     print("Following repositories have failed")
     for repositories in command_fails:
-        print(repositories)
+        print(describe(repositories, results[repositories]))
 
     print("Following repositories are clean")
     for repositories in clean:
-        print(repositories)
+        print(describe(repositories, results[repositories]))
+
+    cached = sum(1 for result in results.values() if result['cached'])
+    print(f"{len(results) - cached} repositories checked, {cached} results taken from the cache")
+
+    if script_config.wheelhouse_path:
+        fresh = [result for result in results.values() if not result['cached']]
+        hits = sum(result['hits'] for result in fresh)
+        misses = sum(result['misses'] for result in fresh)
+        if hits + misses:
+            print(f"Wheelhouse hit rate: {hits / (hits + misses):.0%} ({hits} hits, {misses} misses)")
 
 
 if __name__ == "__main__":
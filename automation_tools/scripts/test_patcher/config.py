@@ -24,6 +24,26 @@ run_tests_sh = 'run-tests.sh'
 setup_cfg = 'setup.cfg'
 setup_py = 'setup.py'
 
+# Download (or refresh) locally the repositories before analyzing them
+download_locally = False
+
+# Files checked out when downloading the repositories (gitignore-style
+# patterns). Repositories are partially cloned without the content of any
+# other file, so syncing refuses a folder holding full clones, and scripts
+# needing full clones (e.g. pip2020) refuse a folder of sparse checkouts.
+# Set to None to download full repositories.
+sparse_paths = ['/' + run_tests_sh, '/' + setup_cfg, '/' + setup_py]
+
+# Number of repositories analyzed, or patched, at the same time
+workers = 16
+
+# Journal of the stages each repository went through (cloned, analyzed,
+# committed, pushed, pr_opened), one JSON line each (None to disable it).
+# Run the script with `--resume` to skip the stages completed by an
+# interrupted run; otherwise a new journal is started (the previous one is
+# renamed after the time it was last written).
+journal_path = 'test_patcher-journal.jsonl'
+
 
 # Github config
 
@@ -37,6 +57,16 @@ remote_branch = "test-command"
 
 base = "master"
 
+# Where the changes are made:
+# - 'worktree': edit the checked out files of master, then commit them
+# - 'objects': write the commits straight into the git object database
+#   without touching the working tree (works on bare repositories too)
+commit_mode = 'worktree'
+
+# Branches patched in 'objects' mode. Each one is pushed to `remote_branch`,
+# suffixed with the branch name if there are several, and its PR targets it.
+branches = [base]
+
 # Message of the commit / Title of the PR (if applicable) / Body of the PR (if applicable)
 message = "tests: bypass setuptools and use pytest"
 title = message
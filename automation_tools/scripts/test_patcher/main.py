@@ -5,28 +5,30 @@
 #
 # Invenio is free software; you can redistribute it and/or modify it
 # under the terms of the MIT License; see LICENSE file for more details.
+import argparse
 import os
+from os import path
 
-from automation_tools.repositories import LocalRepository
+from automation_tools import config
+from automation_tools.journal import Journal
+from automation_tools.repositories import (GithubUtils, LocalRepository,
+                                          parse_status)
 from automation_tools.scripts.test_patcher import config as script_config
-from automation_tools.utils import (file_path, index_of,
-                                    list_local_repository_names, read_content,
+from automation_tools.utils import (list_local_repository_names, read_content,
+                                    read_repository_file, run_parallel,
                                     split_lines)
+from automation_tools.worktrees import WorktreePool, repository_checkout
 
 
-def apply_changes(repository):
-    """Performs the changes on a repository."""
-    filepath = file_path(repository, script_config.run_tests_sh)
-    content = read_content(filepath)
-    file = open(filepath, 'w')
+def patch_run_tests(content):
+    """Substitute the test commands of `run-tests.sh`."""
     content_lines = split_lines(content)
     content_lines = list(map(lambda l: script_config.replacements[l] if l in script_config.replacements else l, content_lines))
-    file.write(os.linesep.join(content_lines))
-    file.close()
+    return os.linesep.join(content_lines)
 
-    filepath = file_path(repository, script_config.setup_cfg)
-    content = read_content(filepath)
-    file = open(filepath, 'w')
+
+def patch_setup_cfg(content):
+    """Remove the `test` alias from `setup.cfg`."""
     content_lines = split_lines(content)
 
     i = 0
@@ -39,70 +41,171 @@ def apply_changes(repository):
             del content_lines[i]
             break
         i += 1
-    file.write(os.linesep.join(content_lines))
-    file.close()
-
-    with LocalRepository(repository) as repo:
-        repo.github_process(
-            script_config.open_pr,
-            script_config.expected,
-            repository,
-            'master',  # Always work on local master
-            script_config.remote_branch,
-            script_config.message,
-            script_config.title,
-            script_config.body,
-            script_config.base,
-            script_config.commit_extra_before,
-            script_config.commit_extra_after
-        )
+    return os.linesep.join(content_lines)
 
 
-def main():
-    count_total = 0
-    count_with_runtests = 0
-    count_with_test_command = 0
-    count_test_substitutable = 0
-    count_with_single_test_alias = 0
+def pull_request(branch):
+    """PR to open for a pushed branch, see ``GithubUtils.open_prs``."""
+    return {'repository': branch['repository'], 'title': script_config.title, 'body': script_config.body,
+            'head': branch['head'], 'base': branch['base']}
 
-    to_patch = []
 
-    for repository in list_local_repository_names():  # List all cloned repositories
-        # Analyze `run-tests.sh`
-        content = read_content(file_path(repository, script_config.run_tests_sh))
-        if content:
-            split = split_lines(content)
+def apply_changes(repository, worktrees=None):
+    """Commits the changes on a repository and returns the branches to push.
+
+    Branches are pushed afterwards, for all the repositories at once, see
+    ``GithubUtils.push_branches``.
+
+    In ``mirror`` storage mode, the changes are made in a worktree of the
+    mirror at ``base``, taken from the ``worktrees`` pool.
+    """
+    if script_config.commit_mode == 'objects':
+        return apply_changes_to_objects(repository)
+
+    with repository_checkout(repository, script_config.base, worktrees) as worktree:
+        return apply_changes_to_worktree(repository, worktree)
+
+
+def apply_changes_to_worktree(repository, worktree):
+    """Performs the changes in the working tree of a repository and commits them."""
+    for filename, patch in ((script_config.run_tests_sh, patch_run_tests),
+                            (script_config.setup_cfg, patch_setup_cfg)):
+        filepath = path.join(worktree, filename)
+        content = patch(read_content(filepath))
+        with open(filepath, 'w') as file:
+            file.write(content)
+
+    with LocalRepository(repository, worktree=worktree) as repo:
+        if not repo.check_status(script_config.expected):
+            raise Exception("Please review modifications")
+        if not repo.commit(script_config.message, script_config.commit_extra_before,
+                           script_config.commit_extra_after):
+            raise Exception("Failed to commit")
+
+        # The commit itself is pushed, as worktrees of mirrors are detached and recycled
+        return [{'repository': repository, 'local_branch': repo.head(),
+                 'head': script_config.remote_branch, 'base': script_config.base}]
+
+
+def apply_changes_to_objects(repository):
+    """Commits the changes on each configured branch, without touching the working tree."""
+    transformations = {
+        script_config.run_tests_sh: patch_run_tests,
+        script_config.setup_cfg: patch_setup_cfg,
+    }
+    expected = [filepath for _, filepath in map(parse_status, script_config.expected)]
+
+    repo = LocalRepository(repository)
+    branches = []
+    for branch in script_config.branches:
+        remote_branch = script_config.remote_branch
+        if len(script_config.branches) > 1:
+            remote_branch = f'{remote_branch}-{branch}'
+
+        repo.commit_objects(branch, remote_branch, transformations, script_config.message,
+                            script_config.commit_extra_before, expected)
 
-            test_substitutable = any(line in script_config.replacements for line in split)
+        branches.append({'repository': repository, 'local_branch': remote_branch,
+                         'head': remote_branch, 'base': branch})
 
-            if test_substitutable:
-                count_test_substitutable += 1
+    return branches
 
-            has_pytest = any(s == 'pytest' or s.startswith('pytest ') or s.startswith('py.test ') for s in split)
 
-            if test_substitutable or not has_pytest:
-                count_with_test_command += 1
+def scan_repository(repository):
+    """Analyze the files of a repository, reading each of them once."""
+    record = {
+        'has_runtests': False,
+        'test_substitutable': False,
+        'has_test_command': False,
+        'single_test_alias': False,
+        'uses_cmdclass': False,
+    }
 
-            count_with_runtests += 1
+    # Analyze `run-tests.sh`
+    content = read_repository_file(repository, script_config.run_tests_sh)
+    if not content:
+        return record
 
-            # Analyze `setup.cfg`
+    has_pytest = False
+    for line in split_lines(content):
+        if line in script_config.replacements:
+            record['test_substitutable'] = True
+        if line == 'pytest' or line.startswith('pytest ') or line.startswith('py.test '):
+            has_pytest = True
 
-            content = read_content(file_path(repository, script_config.setup_cfg))
-            if test_substitutable and content:
-                split = split_lines(content)
-                cmdidx = index_of('test = pytest', split)
-                if not cmdidx:
-                    cmdidx = index_of('test=pytest', split)
-                if cmdidx:
-                    if split[cmdidx - 1] == '[aliases]':
-                        if split[cmdidx + 1] == '':
-                            # See https://github.com/inveniosoftware/flask-menu/blob/master/setup.py#L128
-                            assert 'cmdclass' not in read_content(file_path(repository, script_config.setup_py))
-                            if script_config.should_apply_changes(repository):
-                                to_patch.append(repository)
-                            count_with_single_test_alias += 1
+    record['has_runtests'] = True
+    record['has_test_command'] = record['test_substitutable'] or not has_pytest
 
-        count_total += 1
+    # Analyze `setup.cfg`
+    content = read_repository_file(repository, script_config.setup_cfg)
+    if record['test_substitutable'] and content:
+        split = split_lines(content)
+        spaced_idx = None
+        compact_idx = None
+        for i, line in enumerate(split):
+            if line == 'test = pytest' and spaced_idx is None:
+                spaced_idx = i
+            elif line == 'test=pytest' and compact_idx is None:
+                compact_idx = i
+        cmdidx = spaced_idx or compact_idx
+        if cmdidx and split[cmdidx - 1] == '[aliases]' and cmdidx + 1 < len(split) and split[cmdidx + 1] == '':
+            record['single_test_alias'] = True
+            # See https://github.com/inveniosoftware/flask-menu/blob/master/setup.py#L128
+            record['uses_cmdclass'] = 'cmdclass' in read_repository_file(repository, script_config.setup_py)
+
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Patch the test command of the invenio modules.')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the stages the journal records as completed by the interrupted run')
+    args = parser.parse_args()
+    journal = Journal(script_config.journal_path, args.resume)
+
+    if script_config.download_locally:
+        invenio_repositories = GithubUtils.list_invenio_modules(archived=False)
+        to_download = [repository for repository in invenio_repositories if not journal.find(repository, 'cloned')]
+        if to_download:
+            synced, _ = GithubUtils.download_invenio_modules(to_download,
+                                                             config.local_repositories_path,
+                                                             sync=True,
+                                                             prune=config.prune_local_repositories,
+                                                             sparse_paths=script_config.sparse_paths)
+            for repository in synced:
+                journal.record(repository, 'cloned')
+
+    repositories = sorted(list_local_repository_names())  # List all cloned repositories
+    records = {repository: journal.find(repository, 'analyzed')['record'] for repository in repositories
+               if journal.find(repository, 'analyzed')}
+    analyzed, failed = run_parallel(scan_repository, [r for r in repositories if r not in records], script_config.workers,
+                                    callback=lambda repository, record: journal.record(repository, 'analyzed',
+                                                                                       record=record))
+    records.update(analyzed)
+    for repository, error in failed.items():
+        print(f'Failed to analyze {repository}: {error}')
+
+    count_total = len(repositories)
+    count_with_runtests = 0
+    count_with_test_command = 0
+    count_test_substitutable = 0
+    count_with_single_test_alias = 0
+
+    to_patch = []
+
+    for repository in repositories:
+        record = records.get(repository)
+        if not record:
+            continue
+
+        count_with_runtests += record['has_runtests']
+        count_with_test_command += record['has_test_command']
+        count_test_substitutable += record['test_substitutable']
+        if record['single_test_alias']:
+            assert not record['uses_cmdclass']
+            if script_config.should_apply_changes(repository):
+                to_patch.append(repository)
+            count_with_single_test_alias += 1
 
     print('Total repositories:\t\t\t\t%s' % count_total)
     print('With file `run-tests.sh`:\t\t\t%s' % count_with_runtests)
@@ -117,9 +220,36 @@ def main():
         passcode = 'Yes'
         print('%s repositories will be patched. Type "%s" to confirm.' % (len(to_patch), passcode))
         if input() == passcode:
-            for repository in to_patch:
+            def patch(repository):
                 print('Patching %s...' % repository)
-                apply_changes(repository)
+                return apply_changes(repository, worktrees)
+
+            committed = {repository: journal.find(repository, 'committed')['branches'] for repository in to_patch
+                         if journal.find(repository, 'committed')}
+            with WorktreePool() as worktrees:
+                patched, failed = run_parallel(
+                    patch, [r for r in to_patch if r not in committed], script_config.workers,
+                    callback=lambda repository, branches: journal.record(repository, 'committed', branches=branches))
+            committed.update(patched)
+            for repository, error in failed.items():
+                print('Failed to patch %s: %s' % (repository, error))
+
+            branches = [branch for repository in to_patch for branch in committed.get(repository, [])]
+            GithubUtils.push_branches(
+                [branch for branch in branches if not journal.find(branch['repository'], 'pushed', head=branch['head'])],
+                callback=lambda key, seconds: journal.record(key[0], 'pushed', head=key[1], seconds=seconds))
+
+            if script_config.open_pr:
+                pull_requests = [pull_request(branch) for branch in branches
+                                 if journal.find(branch['repository'], 'pushed', head=branch['head'])
+                                 and not journal.find(branch['repository'], 'pr_opened', head=branch['head'])]
+                opened, failed = GithubUtils.open_prs(
+                    pull_requests, callback=lambda key, url: journal.record(key[0], 'pr_opened', head=key[1], url=url))
+                for (repository, branch), url in opened.items():
+                    print('PR has been opened for %s: %s' % (repository, url))
+                for (repository, branch), error in failed.items():
+                    print('Failed to open the PR of %s (%s): %s' % (repository, branch, error))
+            print('Journal: %s' % ', '.join('%s %s' % (count, stage) for stage, count in journal.report().items()))
             print('Done.')
         else:
             print('Aborting.')
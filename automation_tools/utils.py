@@ -7,9 +7,15 @@
 # under the terms of the MIT License; see LICENSE file for more details.
 
 import os
+import signal
 import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
 
+import pygit2
+
 from automation_tools import config
 
 
@@ -21,11 +27,94 @@ def file_path(repository, filename):
 def read_content(filepath):
     """Returns the content of a file as a string if it exists or None."""
     if path.exists(filepath):
-        return open(filepath, 'r').read()
+        with open(filepath, 'r') as f:
+            return f.read()
     else:
         return None
 
 
+def repository_tree(repository, ref=None):
+    """Returns the git tree of a repository at ``ref``, or None to read its working tree.
+
+    ``ref`` defaults to ``config.repository_ref``, or to ``HEAD`` for bare
+    mirrors which have no working tree.
+    """
+    ref = ref or config.repository_ref or ('HEAD' if config.storage_mode == 'mirror' else None)
+    if ref is None:
+        return None
+
+    repository_path = path.join(config.local_repositories_path, repository)
+    return open_repository(repository_path).revparse_single(ref).peel(pygit2.Tree)
+
+
+# Last repository opened by each thread
+_opened = threading.local()
+
+
+def open_repository(repository_path):
+    """Returns the git repository at a path, reusing the last one opened by the thread.
+
+    Files of a repository are read one after the other, so they are all read
+    from the same repository object.
+    """
+    if getattr(_opened, 'path', None) != repository_path:
+        _opened.repository = pygit2.Repository(repository_path)
+        _opened.path = repository_path
+    return _opened.repository
+
+
+def read_repository_file(repository, filename, ref=None):
+    """Returns the content of a repository file as a string if it exists or None.
+
+    The file is read from the working tree, or straight from the git object
+    store at ``ref`` (see ``repository_tree``), which also works on bare
+    mirrors.
+    """
+    try:
+        tree = repository_tree(repository, ref)
+        if tree is None:
+            return read_content(file_path(repository, filename))
+        entry = tree[filename]
+    except (KeyError, pygit2.GitError):
+        return None
+    return read_blob(open_repository(path.join(config.local_repositories_path, repository)), entry.id)
+
+
+def list_repository_files(repository, ref=None):
+    """Returns the sorted names of the entries at the root of a repository, if it exists."""
+    try:
+        tree = repository_tree(repository, ref)
+        if tree is None:
+            return sorted(name for name in os.listdir(file_path(repository, '')) if name != '.git')
+        return sorted(entry.name for entry in tree)
+    except (OSError, KeyError, pygit2.GitError):
+        return []
+
+
+# Contents of the blobs last read, by oid
+_blobs = OrderedDict()
+_blobs_lock = threading.Lock()
+
+
+def read_blob(repo, oid):
+    """Returns the content of a blob as a string.
+
+    Blobs never change and are identified by their content, so the contents
+    are cached by oid alone and shared between the repositories having the
+    same files (e.g. forks).
+    """
+    with _blobs_lock:
+        if oid in _blobs:
+            _blobs.move_to_end(oid)
+            return _blobs[oid]
+    content = repo[oid].data.decode()
+    with _blobs_lock:
+        _blobs[oid] = content
+        while len(_blobs) > config.blob_cache_size:
+            _blobs.popitem(last=False)
+    return content
+
+
 def split_lines(content):
     """Returns a list of strings corresponding to the lines of this string."""
     return content.split(os.linesep)
@@ -38,17 +127,88 @@ def index_of(string, values):
     except ValueError:
         return None
 
-def execute(cmd):
-    """Snippet from https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running."""
-    popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-    for stdout_line in iter(popen.stdout.readline, ""):
-        yield stdout_line 
-    popen.stdout.close()
-    return_code = popen.wait()
-    if return_code:
+def execute(cmd, merge_stderr=False, until=None, timeout=None, cwd=None):
+    """Snippet from https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running.
+
+    With ``merge_stderr``, error output lines are yielded along with the
+    standard output ones. Once ``until`` returns True for a line, that line
+    is yielded and the command is killed without raising. If the command
+    runs for more than ``timeout`` seconds, it is killed and
+    ``subprocess.TimeoutExpired`` is raised. The command runs in ``cwd``.
+
+    The command runs in a process group of its own, which is killed as a
+    whole, so that the processes it spawned (e.g. build backends) do not
+    outlive it.
+    """
+    popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, cwd=cwd,
+                             stderr=subprocess.STDOUT if merge_stderr else None, start_new_session=True)
+    timed_out = threading.Event()
+
+    def kill():
+        kill_process_group(popen)
+
+    def expire():
+        timed_out.set()
+        kill()
+
+    timer = threading.Timer(timeout, expire) if timeout else None
+    if timer:
+        timer.start()
+    stopped = False
+    try:
+        for stdout_line in iter(popen.stdout.readline, ""):
+            if until and until(stdout_line):
+                stopped = True
+                kill()
+            yield stdout_line
+            if stopped:
+                break
+    except GeneratorExit:
+        # The consumer stopped reading, do not wait for the command to finish
+        stopped = True
+        kill()
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+        popen.stdout.close()
+        return_code = popen.wait()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if return_code and not stopped:
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
+def kill_process_group(popen):
+    """Kill a command started in a session of its own, along with the processes it spawned."""
+    try:
+        os.killpg(popen.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_command(cmd, timeout=None, cwd=None):
+    """Run a command, raising like ``subprocess.run(..., check=True)``, and return its output.
+
+    The output and error output are captured as strings. As with
+    ``execute``, the command runs in a process group of its own, killed as a
+    whole on timeout, so that its helpers (e.g. the transport processes of
+    git) stop writing before the caller cleans up.
+    """
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                          cwd=cwd, start_new_session=True) as popen:
+        try:
+            stdout, stderr = popen.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(popen)
+            stdout, stderr = popen.communicate()
+            raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr)
+    if popen.returncode:
+        raise subprocess.CalledProcessError(popen.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, popen.returncode, stdout, stderr)
+
+
 def list_directory_names(parent_directory):
     """List directory names inside the parent directory."""
     if path.exists(parent_directory) and os.path.isdir(parent_directory):
@@ -60,3 +220,43 @@ def list_directory_names(parent_directory):
 def list_local_repository_names():
     """List locally cloned repositories."""
     return list_directory_names(config.local_repositories_path)
+
+
+def git_ssh_environment():
+    """Environment of the git commands sharing one SSH connection per host.
+
+    The first SSH connection to a host becomes the master of a multiplexed
+    connection, that the next git commands reuse, instead of doing their own
+    handshake, for ``ssh_control_persist`` seconds after the last one.
+    """
+    control_directory = path.expanduser(config.ssh_control_directory)
+    os.makedirs(control_directory, mode=0o700, exist_ok=True)
+    ssh_command = os.environ.get('GIT_SSH_COMMAND', 'ssh')
+    return dict(os.environ, GIT_SSH_COMMAND=f'{ssh_command} -o ControlMaster=auto '
+                                            f'-o ControlPath={path.join(control_directory, "%C")} '
+                                            f'-o ControlPersist={config.ssh_control_persist}')
+
+
+def run_parallel(function, items, workers=None, executor_class=ThreadPoolExecutor, callback=None):
+    """Run a function on every item concurrently.
+
+    Returns two dictionaries keyed by item: the results of the calls that
+    succeeded and the exceptions raised by the ones that failed. If given,
+    ``callback`` is called, in the calling thread, with each item and its
+    result as soon as the call succeeds.
+    """
+    results = {}
+    errors = {}
+    with executor_class(max_workers=workers) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                errors[item] = e
+            else:
+                if callback:
+                    callback(item, results[item])
+
+    return results, errors
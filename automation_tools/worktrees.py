@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2020 CERN.
+#
+# Invenio is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Disposable working trees of the mirrored repositories."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from os import path
+
+from automation_tools import config
+
+
+def git(*args):
+    """Run a git command quietly, raising on failure."""
+    subprocess.run(["git"] + list(args), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+class WorktreePool(object):
+    """Pool of detached worktrees of bare mirrors.
+
+    A worktree shares the object database of its mirror, so adding one only
+    writes the checked out files. Once used, it is cleaned and kept for the
+    next checkout of the same repository, which then only has to switch the
+    changed files. Worktrees are removed when the pool is closed.
+
+    Checkouts can be taken from several threads at the same time, each one
+    gets a worktree of its own.
+    """
+    def __init__(self, worktrees_path=None):
+        self.path = worktrees_path or config.local_worktrees_path
+        self.lock = threading.Lock()
+        self.free = defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextmanager
+    def checkout(self, repository, ref='HEAD'):
+        """Yield the path of a worktree of a mirror, detached at ``ref``."""
+        with self.lock:
+            worktree = self.free[repository].pop() if self.free[repository] else None
+
+        if worktree is None:
+            os.makedirs(self.path, exist_ok=True)
+            worktree = tempfile.mkdtemp(prefix=f'{repository}-', dir=self.path)
+            try:
+                git("-C", path.join(config.local_repositories_path, repository),
+                    "worktree", "add", "--quiet", "--detach", worktree, ref)
+            except subprocess.CalledProcessError:
+                shutil.rmtree(worktree)
+                raise
+        else:
+            git("-C", worktree, "checkout", "--quiet", "--force", "--detach", ref)
+
+        try:
+            yield worktree
+        except BaseException:
+            self.remove(repository, worktree)
+            raise
+
+        try:
+            git("-C", worktree, "reset", "--quiet", "--hard")
+            git("-C", worktree, "clean", "--quiet", "-fdx")
+        except subprocess.CalledProcessError:
+            self.remove(repository, worktree)
+            return
+        with self.lock:
+            self.free[repository].append(worktree)
+
+    def remove(self, repository, worktree):
+        """Remove a worktree and its administrative files from the mirror."""
+        subprocess.run(["git", "-C", path.join(config.local_repositories_path, repository),
+                        "worktree", "remove", "--force", worktree],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if path.exists(worktree):
+            shutil.rmtree(worktree)
+
+    def close(self):
+        """Remove the worktrees kept for later checkouts."""
+        with self.lock:
+            free, self.free = self.free, defaultdict(list)
+        for repository, worktrees in free.items():
+            for worktree in worktrees:
+                self.remove(repository, worktree)
+
+
+@contextmanager
+def repository_checkout(repository, ref='HEAD', pool=None):
+    """Yield the path of a working tree of a local repository.
+
+    In ``clone`` storage mode this is the clone itself, as it is checked out.
+    In ``mirror`` storage mode it is a worktree of the mirror at ``ref``,
+    taken from ``pool`` or from a pool of its own otherwise.
+    """
+    if config.storage_mode != 'mirror':
+        yield path.join(config.local_repositories_path, repository)
+    elif pool is not None:
+        with pool.checkout(repository, ref) as worktree:
+            yield worktree
+    else:
+        with WorktreePool() as pool, pool.checkout(repository, ref) as worktree:
+            yield worktree